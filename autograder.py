@@ -1,13 +1,24 @@
 from cspbase import *
+import io
 import itertools
+import json
 import traceback
 
-from kropki_csp import kropki_csp_model_1, kropki_csp_model_2, KropkiBoard
-from propagators import prop_FC,  prop_GAC, ord_mrv
+from kropki_csp import (kropki_csp_model_1, kropki_csp_model_2, KropkiBoard, solve_kropki,
+                        count_kropki_solutions, kropki_solutions, ConsecutiveConstraint,
+                        DoubleConstraint, NoDotConstraint, check_box_shape,
+                        default_box_shape)
+from propagators import (prop_FC, prop_GAC, ord_mrv, ord_dom_wdeg, prop_BT, prop_SAC,
+                         prop_UNITS)
+from kropki_parallel import (solve_kropki_batch, solve_kropki_split,
+                             count_kropki_solutions_split, KropkiPortfolio)
+from kropki_io import read_board_records, result_to_json, write_boards
+from kropki_dlx import count_kropki_solutions_dlx, kropki_solutions_dlx, solve_kropki_dlx
 
 test_ord_mrv = True
 test_props = True
 test_model = True
+test_engines = True
 
 b1 = KropkiBoard(6,[[1,6,5,4,-1,3],
        [3,2,6,1,-1,4],
@@ -227,6 +238,681 @@ def test_ord_mrv_fun():
 
     return 0
 
+##Tests AllDiff GAC on pigeonhole domains: A, B in {1,2} take both values,
+##so C in {1,2,3} must be 3 and D in {1,2,3,4} must be 4; with a third
+##variable in {1,2} there is no solution.
+def test_alldiff_pigeonhole():
+    score = 0
+    try:
+        vs = [Variable('A', [1, 2]), Variable('B', [1, 2]), Variable('C', [1, 2, 3]), Variable('D', [1, 2, 3, 4])]
+        csp = CSP("Pigeonhole", vs)
+        csp.add_constraint(AllDiffConstraint("AllDiff", vs))
+        status, pruned = prop_GAC(csp)
+        answer = [[1, 2], [1, 2], [3], [4]]
+        var_vals = [x.cur_domain() for x in vs]
+
+        ws = [Variable('A', [1, 2]), Variable('B', [1, 2]), Variable('C', [1, 2]), Variable('D', [1, 2, 3, 4])]
+        csp = CSP("Pigeonhole", ws)
+        csp.add_constraint(AllDiffConstraint("AllDiff", ws))
+        status2, pruned = prop_GAC(csp)
+
+        if not status or var_vals != answer:
+            details = "Failed AllDiff pigeonhole test: variable domains don't match expected results"
+        elif status2:
+            details = "Failed AllDiff pigeonhole test: three variables over two values were not refuted"
+        else:
+            score = 1
+            details = ""
+    except Exception:
+        details = "One or more runtime errors occurred while testing AllDiff: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that a BitVariable's current domain follows the same prunings,
+##restorations and assignments as a Variable's.
+def test_bitvariable_domains():
+    score = 0
+    try:
+        details = ""
+        doms = []
+        for var in [Variable('X', [1, 2, 3, 4, 5]), BitVariable('Y', [1, 2, 3, 4, 5])]:
+            steps = []
+            var.prune_value(2)
+            var.prune_value(4)
+            steps.append((var.cur_domain(), var.cur_domain_size(), var.in_cur_domain(2), var.in_cur_domain(3)))
+            var.unprune_value(4)
+            steps.append((var.cur_domain(), var.cur_domain_size(), var.in_cur_domain(4)))
+            var.assign(3)
+            steps.append((var.cur_domain(), var.cur_domain_size(), var.in_cur_domain(1)))
+            var.unassign()
+            var.restore_curdom()
+            steps.append((var.cur_domain(), var.cur_domain_size()))
+            doms.append(steps)
+        if doms[0] != doms[1]:
+            details = "Failed BitVariable test: current domains don't match Variable's"
+        elif doms[1][0] != ([1, 3, 5], 3, False, True):
+            details = "Failed BitVariable test: pruned domain doesn't match expected results"
+        else:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing BitVariable: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that undoing a Trail restores every value pruned since its mark, and
+##that a CSP can be searched again after a search that used the trail.
+def test_trail_undo():
+    score = 0
+    try:
+        details = ""
+        vs = [BitVariable('A', [1, 2, 3]), Variable('B', [1, 2, 3])]
+        csp = CSP("Trail", vs)
+        trail = Trail(2)
+        csp.attach_trail(trail)
+        vs[0].prune_value(1)
+        mark = trail.mark()
+        vs[0].prune_value(3)
+        vs[1].prune_value(2)
+        vs[1].prune_value(3)
+        pruned = trail.prunings_since(mark)
+        trail.undo(mark)
+        csp.detach_trail()
+        if pruned != [(vs[0], 3), (vs[1], 2), (vs[1], 3)]:
+            details = "Failed trail test: prunings_since doesn't match expected results"
+        elif [v.cur_domain() for v in vs] != [[2, 3], [1, 2, 3]]:
+            details = "Failed trail test: undo didn't restore the domains at the mark"
+
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            csp, var_array = kropki_csp_model_1(b)
+            solver = BT(csp)
+            solver.quiet_on()
+            if solver.count_solutions(prop_GAC, var_ord=ord_mrv) != 1:
+                details = "Failed trail test: wrong number of solutions"
+            elif any(v.cur_domain_size() != v.domain_size() for v in var_array if not v.is_assigned()):
+                details = "Failed trail test: domains not restored after search"
+            else:
+                solver.bt_search(prop_GAC, var_ord=ord_mrv)
+                if not check_solution(var_array, sol):
+                    details = "Failed trail test: second search did not find the solution"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing the trail: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that DomainSizeIndex selects a variable of smallest current domain
+##(most constrained on ties) as domains are pruned and variables assigned.
+def test_size_index():
+    score = 0
+    try:
+        details = ""
+        a = BitVariable('A', [1, 2, 3])
+        b = BitVariable('B', [1, 2, 3])
+        c = BitVariable('C', [1, 2, 3, 4])
+        csp = CSP("Index", [a, b, c])
+        csp.add_constraint(AllDiffConstraint("AB", [a, b]))
+        csp.add_constraint(AllDiffConstraint("BC", [b, c]))
+        index = csp.attach_size_index()
+        picks = [index.select()]
+        c.prune_value(1)
+        c.prune_value(2)
+        picks.append(index.select())
+        c.assign(3)
+        picks.append(index.select())
+        picks.append(len(index))
+        c.unassign()
+        c.restore_curdom()
+        picks.append(index.select())
+        csp.detach_size_index()
+        if picks != [b, c, b, 2, b]:
+            details = "Failed DomainSizeIndex test: selected variables don't match expected results"
+        else:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing DomainSizeIndex: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that ord_dom_wdeg prefers variables in constraints that caused wipe
+##outs, and that search with it finds the solutions of b1 and b2.
+def test_dom_wdeg():
+    score = 0
+    try:
+        details = ""
+        x = Variable('X', [1, 2])
+        y = Variable('Y', [1, 2, 3])
+        z = Variable('Z', [1, 2])
+        csp = CSP("Weights", [x, y, z])
+        xy = AllDiffConstraint("XY", [x, y])
+        csp.add_constraint(xy)
+        csp.add_constraint(AllDiffConstraint("YZ", [y, z]))
+        first = ord_dom_wdeg(csp)
+        xy.weight = 5
+        second = ord_dom_wdeg(csp)
+        if first != y or second != x:
+            details = "Failed dom/wdeg test: selected variables don't match expected results"
+
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            for model in [kropki_csp_model_1, kropki_csp_model_2]:
+                csp, var_array = model(b)
+                solver = BT(csp)
+                solver.quiet_on()
+                solver.bt_search(prop_FC, var_ord=ord_dom_wdeg)
+                if not check_solution(var_array, sol):
+                    details = "Failed dom/wdeg test: search did not find the solution"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing dom/wdeg: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that has_support with residual supports agrees with a scan of the
+##satisfying tuples, before and after the residues are cached.
+def test_residues():
+    score = 0
+    try:
+        details = ""
+        csp, var_array = kropki_csp_model_1(b2)
+        table_cons = [c for c in csp.get_all_cons() if len(c.table) > 0]
+        for prunes in [[(0, 1), (1, 2), (6, 1)], [(0, 3), (7, 2), (1, 4)]]:
+            for k, val in prunes:
+                var_array[k].prune_value(val)
+            for rounds in range(2):
+                for c in table_cons:
+                    for var in c.get_scope():
+                        for val in var.cur_domain():
+                            i = c.get_scope().index(var)
+                            expected = any(t[i] == val and all(w.in_cur_domain(v) for w, v in zip(c.get_scope(), t))
+                                           for t in c.sat_tuples)
+                            if c.has_support(var, val) != expected:
+                                details = "Failed residue test: has_support doesn't match the satisfying tuples"
+        checks, hits = csp.residue_stats()
+        if not details and (checks == 0 or hits == 0):
+            details = "Failed residue test: residual supports were never used"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing residual supports: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that Compact-Table filtering gives the same GAC domains and solution
+##counts as the default table filtering on b1 and b2.
+def test_compact_table():
+    score = 0
+    try:
+        details = ""
+        for b in [b1, b2]:
+            results = []
+            for compact in [False, True]:
+                csp, var_array = kropki_csp_model_1(b)
+                if compact:
+                    csp.use_compact_tables()
+                prop_GAC(csp)
+                doms = [v.cur_domain() for v in var_array]
+                results.append((doms, BT(csp).count_solutions(prop_GAC, var_ord=ord_mrv)))
+            if results[0] != results[1]:
+                details = "Failed Compact-Table test: domains or counts don't match table filtering"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing Compact-Table: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests TupleTable membership, duplicates and per position supports.
+def test_tuple_table():
+    score = 0
+    try:
+        details = ""
+        table = TupleTable(2)
+        table.add([(1, 2), (2, 1), (1, 3)])
+        table.add([[1, 2], (3, 1)])
+        if len(table) != 4:
+            details = "Failed TupleTable test: wrong number of tuples"
+        elif not all(table.contains(t) for t in [(1, 2), (2, 1), (1, 3), (3, 1)]):
+            details = "Failed TupleTable test: an added tuple is missing"
+        elif table.contains((2, 3)) or table.contains((1, 4)):
+            details = "Failed TupleTable test: contains a tuple that was not added"
+        elif sorted(table.tuples()) != [(1, 2), (1, 3), (2, 1), (3, 1)]:
+            details = "Failed TupleTable test: tuples don't match expected results"
+        else:
+            order, start, end = table.support_range(0, 1)
+            if sorted(table.row(order[k]) for k in range(start, end)) != [(1, 2), (1, 3)]:
+                details = "Failed TupleTable test: supports of a value don't match expected results"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing TupleTable: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that constraints over the same relation share one interned table, and
+##that adding tuples to one of them does not change the others.
+def test_shared_relations():
+    score = 0
+    try:
+        details = ""
+        csp1, vars1 = kropki_csp_model_1(b1)
+        csp2, vars2 = kropki_csp_model_1(b2)
+        neq = [c for c in csp1.get_all_cons() + csp2.get_all_cons()
+               if c.shared_table and all(v.domain_size() == b1.dim for v in c.get_scope())]
+        if len(neq) < 2 or any(c.table is not neq[0].table for c in neq):
+            details = "Failed shared relation test: NOT-EQUAL constraints don't share one table"
+        else:
+            size = len(neq[1].table)
+            neq[0].add_satisfying_tuples([(1, 1)])
+            if len(neq[1].table) != size or neq[0].table is neq[1].table or len(neq[0].table) != size + 1:
+                details = "Failed shared relation test: adding tuples changed a shared table"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing shared relations: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that models instantiated from the compiled templates give the same
+##solutions and counts as models built from scratch, whatever board the
+##template was instantiated for before.
+def test_compiled_templates():
+    score = 0
+    try:
+        details = ""
+        for model in [1, 2]:
+            for b, sol in [(b1, b1sol), (b2, b2sol), (b1, b1sol)]:
+                result = solve_kropki(b, model, prop_GAC, ord_mrv, compiled=True)
+                if result.solution != sol.cell_values:
+                    details = "Failed template test: compiled model did not find the solution"
+                elif count_kropki_solutions(b, None, model, compiled=True) != \
+                     count_kropki_solutions(b, None, model, compiled=False):
+                    details = "Failed template test: compiled and fresh models count different solutions"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing templates: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that batch solving over two processes gives, in order, the results of
+##solving each board on its own.
+def test_batch():
+    score = 0
+    try:
+        details = ""
+        boards = [b1, b2, b1, b2]
+        results = list(solve_kropki_batch(boards, model=2, processes=2))
+        if [r.index for r in results] != list(range(len(boards))):
+            details = "Failed batch test: results are not in the order of the boards"
+        elif [r.solution for r in results] != [solve_kropki(b, 2).solution for b in boards]:
+            details = "Failed batch test: solutions don't match serial solving"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing batch solving: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that boards survive a JSON lines round trip, and that a bad line is
+##reported without stopping the stream.
+def test_json_lines():
+    score = 0
+    try:
+        details = ""
+        stream = io.StringIO()
+        write_boards(stream, [b1, b2])
+        lines = stream.getvalue().splitlines()
+        lines.insert(1, '{"dim":6')
+        records = list(read_board_records(["# boards", ""] + lines))
+        boards = [board for board, error in records]
+        fields = ["dim", "cell_values", "consec_row", "consec_col", "double_row", "double_col"]
+        if len(records) != 3 or boards[1] != None or records[1][1] == None:
+            details = "Failed JSON test: the bad line was not reported in place"
+        elif any(getattr(a, f) != getattr(b, f) for a, b in [(boards[0], b1), (boards[2], b2)] for f in fields):
+            details = "Failed JSON test: boards changed in the round trip"
+        elif json.loads(result_to_json(solve_kropki(boards[2])))["solution"] != b2sol.cell_values:
+            details = "Failed JSON test: solution line doesn't match expected results"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing JSON lines: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests solution enumeration: b1 and b2 have a unique solution, and the
+##solution of b1 with its first two rows and its dots removed has as many
+##solutions as kropki_solutions generates, all different.
+def test_enumeration():
+    score = 0
+    try:
+        details = ""
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            if count_kropki_solutions(b) != 1:
+                details = "Failed enumeration test: board does not have a unique solution"
+            elif list(kropki_solutions(b)) != [sol.cell_values]:
+                details = "Failed enumeration test: solutions don't match expected results"
+
+        cells = [[-1] * 6, [-1] * 6] + [list(row) for row in b1sol.cell_values[2:]]
+        no_dots = [[0] * 5 for i in range(6)]
+        b = KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots)
+        solns = list(kropki_solutions(b, model=2, propagator=prop_FC))
+        if count_kropki_solutions(b, limit=None) != len(solns) or len(solns) != 4:
+            details = "Failed enumeration test: count doesn't match the solutions generated"
+        elif len(set(str(s) for s in solns)) != len(solns) or b1sol.cell_values not in solns:
+            details = "Failed enumeration test: solutions repeated or missing"
+        elif count_kropki_solutions(b, limit=1) != 1:
+            details = "Failed enumeration test: count did not stop at the limit"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing enumeration: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that splitting the search of b2 over two processes finds its solution
+##and counts as many solutions as a serial search.
+def test_split():
+    score = 0
+    try:
+        details = ""
+        result = solve_kropki_split(b2, processes=2)
+        if result.solution != b2sol.cell_values:
+            details = "Failed split test: solution doesn't match expected results"
+        elif count_kropki_solutions_split(b2, processes=2) != count_kropki_solutions(b2, limit=None):
+            details = "Failed split test: count doesn't match serial search"
+        elif count_kropki_solutions_split(b2, processes=2, depth=1) != 1:
+            details = "Failed split test: count at depth 1 doesn't match serial search"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing split search: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that a portfolio solves several boards with the same workers and
+##credits each board to one configuration.
+def test_portfolio():
+    score = 0
+    try:
+        details = ""
+        with KropkiPortfolio() as portfolio:
+            for b, sol in [(b1, b1sol), (b2, b2sol), (b1, b1sol)]:
+                if portfolio.solve(b).solution != sol.cell_values:
+                    details = "Failed portfolio test: solution doesn't match expected results"
+        if portfolio.nBoards != 3 or sum(portfolio.wins) != 3:
+            details = "Failed portfolio test: wins don't add up to the boards solved"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing the portfolio: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that randomized restarts with nogoods find the solutions of b1 and b2
+##with both models, and leave csp.rng as it was.
+def test_restarts():
+    score = 0
+    try:
+        details = ""
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            for model in [kropki_csp_model_1, kropki_csp_model_2]:
+                csp, var_array = model(b)
+                solver = BT(csp)
+                solver.quiet_on()
+                solver.bt_search_restarts(prop_FC, var_ord=ord_mrv, base=10, seed=1)
+                if not check_solution(var_array, sol):
+                    details = "Failed restarts test: bt_search_restarts did not find the solution"
+                elif csp.rng is not None:
+                    details = "Failed restarts test: csp.rng was not restored"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing restarts: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that conflict-directed backjumping finds the solutions of b1 and b2
+##with both models, and refutes a board with no solution.
+def test_cbj():
+    score = 0
+    try:
+        details = ""
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            for model in [kropki_csp_model_1, kropki_csp_model_2]:
+                csp, var_array = model(b)
+                solver = BT(csp)
+                solver.quiet_on()
+                solver.bt_search_cbj(prop_FC, var_ord=ord_mrv)
+                if not check_solution(var_array, sol):
+                    details = "Failed CBJ test: bt_search_cbj did not find the solution"
+
+        #a consecutive dot after the 4 of b1's first row: 3 and 5 are taken
+        consec_row = [list(row) for row in b1.consec_row]
+        consec_row[0][3] = 1
+        b = KropkiBoard(6, b1.cell_values, consec_row, b1.consec_col, b1.double_row, b1.double_col)
+        csp, var_array = kropki_csp_model_1(b)
+        solver = BT(csp)
+        solver.quiet_on()
+        if solver.bt_search_cbj(prop_BT, var_ord=ord_mrv):
+            details = "Failed CBJ test: found a solution of a board with none"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing CBJ: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that the dot constraints prune exactly the values without a related
+##value in the other cell, and that the negative rule keeps the solution of
+##b2 (which follows it) and refutes b1 (which does not).
+def test_dot_constraints():
+    score = 0
+    try:
+        details = ""
+        for cls in [ConsecutiveConstraint, DoubleConstraint, NoDotConstraint]:
+            for xmask in range(1, 64, 5):
+                for ymask in range(1, 64, 3):
+                    x = BitVariable('X', [1, 2, 3, 4, 5, 6])
+                    y = BitVariable('Y', [1, 2, 3, 4, 5, 6])
+                    for var, mask in [(x, xmask), (y, ymask)]:
+                        for val in range(1, 7):
+                            if not mask >> (val-1) & 1:
+                                var.prune_value(val)
+                    c = cls("Dot", [x, y])
+                    expected = set((v, a) for v, w in [(x, y), (y, x)] for a in v.cur_domain()
+                                   if not any(c.related(a, b) for b in w.cur_domain()))
+                    if set(c.unsupported_values()) != expected:
+                        details = "Failed dot constraint test: %s pruned the wrong values" % cls.__name__
+        if count_kropki_solutions(b2, limit=None, no_dot=True) != 1:
+            details = "Failed dot constraint test: negative rule lost the solution of b2"
+        elif count_kropki_solutions(b1, limit=None, no_dot=True) != 0:
+            details = "Failed dot constraint test: negative rule did not refute b1"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing dot constraints: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that singleton arc consistency prunes at least as much as GAC and no
+##value of the solution, and that search after it finds the solutions.
+def test_sac():
+    score = 0
+    try:
+        details = ""
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            doms = []
+            for prop in [prop_GAC, prop_SAC]:
+                csp, var_array = kropki_csp_model_1(b)
+                prop(csp)
+                doms.append([v.cur_domain() for v in var_array])
+            values = [val for row in sol.cell_values for val in row]
+            if any(not set(s) <= set(g) for s, g in zip(doms[1], doms[0])):
+                details = "Failed SAC test: SAC kept a value GAC pruned"
+            elif any(val not in dom for val, dom in zip(values, doms[1])):
+                details = "Failed SAC test: SAC pruned a value of the solution"
+            elif solve_kropki(b, preprocess=prop_SAC).solution != sol.cell_values:
+                details = "Failed SAC test: search after SAC did not find the solution"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing SAC: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that unit inference finds the solutions of b1 and b2 with both models,
+##and counts as many solutions as GAC on a board with several.
+def test_units():
+    score = 0
+    try:
+        details = ""
+        for model in [1, 2]:
+            for b, sol in [(b1, b1sol), (b2, b2sol)]:
+                if solve_kropki(b, model, prop_UNITS).solution != sol.cell_values:
+                    details = "Failed unit inference test: search did not find the solution"
+            no_dots = [[0] * 5 for i in range(6)]
+            cells = [[-1] * 6, [-1] * 6] + [list(row) for row in b1sol.cell_values[2:]]
+            b = KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots)
+            if count_kropki_solutions(b, None, model, prop_UNITS) != count_kropki_solutions(b, None, model, prop_GAC):
+                details = "Failed unit inference test: count doesn't match GAC"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing unit inference: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests box shapes: a 6x6 board with 2x3 sub-squares (the transpose of the
+##default) is solved with its own sub-squares, bad shapes are rejected and
+##prime dimensions default to no sub-squares.
+def test_box_shapes():
+    score = 0
+    try:
+        details = ""
+        #row r of the solution is 1..6 rotated so that 2x3 boxes are all different
+        sol = [[(3 * (r % 2) + r // 2 + c) % 6 + 1 for c in range(6)] for r in range(6)]
+        cells = [[val if (r + c) % 3 == 0 else -1 for c, val in enumerate(row)] for r, row in enumerate(sol)]
+        no_dots = [[0] * 5 for i in range(6)]
+        b = KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots, 2, 3)
+        for model in [1, 2]:
+            solns = list(kropki_solutions(b, model, limit=None))
+            for s in solns:
+                for name, unit in b.units():
+                    if sorted(s[i][j] for i, j in unit) != list(range(1, 7)):
+                        details = "Failed box shape test: solution breaks the 2x3 sub-squares"
+            if sol not in solns:
+                details = "Failed box shape test: the 2x3 solution was not found"
+        if b.box_shape() != (2, 3) or default_box_shape(6) != (3, 2) or default_box_shape(7) != (1, 7):
+            details = "Failed box shape test: box shapes don't match expected results"
+        try:
+            check_box_shape(6, (4, 2))
+            details = "Failed box shape test: 4x2 sub-squares accepted for dimension 6"
+        except ValueError:
+            pass
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing box shapes: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that the NumPy tensor engine finds the same solutions as BT search.
+def test_tensor():
+    score = 0
+    try:
+        from kropki_numpy import KropkiTensor, solve_kropki_tensor
+        details = ""
+        no_dots = [[0] * 5 for i in range(6)]
+        cells = [[-1] * 6, [-1] * 6] + [list(row) for row in b1sol.cell_values[2:]]
+        for b in [b1, b2, KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots)]:
+            for no_dot in [False, True]:
+                solns = sorted(KropkiTensor(b, no_dot).solutions())
+                if solns != sorted(kropki_solutions(b, no_dot=no_dot)):
+                    details = "Failed tensor test: solutions don't match BT search"
+        for b, sol in [(b1, b1sol), (b2, b2sol)]:
+            if solve_kropki_tensor(b).solution != sol.cell_values:
+                details = "Failed tensor test: solution doesn't match expected results"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing the tensor engine: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that batched tensor propagation gives, in order, the solutions of
+##solving each board on its own, across batches of different sizes.
+def test_tensor_batch():
+    score = 0
+    try:
+        from kropki_numpy import solve_kropki_tensor_batch
+        details = ""
+        no_dots = [[0] * 5 for i in range(6)]
+        cells = [[-1] * 6, [-1] * 6] + [list(row) for row in b1sol.cell_values[2:]]
+        boards = [b1, b2, KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots), b2, b1]
+        expected = [list(kropki_solutions(b)) for b in boards]
+        for batch_size in [1, 2, 8]:
+            results = list(solve_kropki_tensor_batch(boards, batch_size=batch_size))
+            if [r.index for r in results] != list(range(len(boards))):
+                details = "Failed tensor batch test: results are not in the order of the boards"
+            elif any(r.solution not in solns for r, solns in zip(results, expected)):
+                details = "Failed tensor batch test: solutions don't match serial solving"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing tensor batches: %r" % traceback.format_exc()
+
+    return score,details
+
+##Tests that DLX counts as many solutions as count_kropki_solutions, with and
+##without the negative rule, and finds the same solutions.
+def test_dlx_counts():
+    score = 0
+    try:
+        details = ""
+        no_dots = [[0] * 5 for i in range(6)]
+        cells = [[-1] * 6, [-1] * 6] + [list(row) for row in b1sol.cell_values[2:]]
+        b3 = KropkiBoard(6, cells, no_dots, no_dots, no_dots, no_dots)
+        for b, sol in [(b1, b1sol), (b2, b2sol), (b3, None)]:
+            for no_dot in [False, True]:
+                if count_kropki_solutions_dlx(b, None, no_dot) != count_kropki_solutions(b, None, no_dot=no_dot):
+                    details = "Failed DLX test: solution counts don't match count_kropki_solutions"
+            if sol != None and solve_kropki_dlx(b).solution != sol.cell_values:
+                details = "Failed DLX test: solution doesn't match expected results"
+        if sorted(kropki_solutions_dlx(b3)) != sorted(kropki_solutions(b3)):
+            details = "Failed DLX test: solutions don't match kropki_solutions"
+        if not details:
+            score = 1
+    except Exception:
+        details = "One or more runtime errors occurred while testing DLX: %r" % traceback.format_exc()
+
+    return score,details
+
+engine_tests = [("test_alldiff_pigeonhole", test_alldiff_pigeonhole),
+                ("test_bitvariable_domains", test_bitvariable_domains),
+                ("test_trail_undo", test_trail_undo),
+                ("test_size_index", test_size_index),
+                ("test_dom_wdeg", test_dom_wdeg),
+                ("test_residues", test_residues),
+                ("test_compact_table", test_compact_table),
+                ("test_tuple_table", test_tuple_table),
+                ("test_shared_relations", test_shared_relations),
+                ("test_compiled_templates", test_compiled_templates),
+                ("test_batch", test_batch),
+                ("test_json_lines", test_json_lines),
+                ("test_enumeration", test_enumeration),
+                ("test_split", test_split),
+                ("test_portfolio", test_portfolio),
+                ("test_restarts", test_restarts),
+                ("test_cbj", test_cbj),
+                ("test_dot_constraints", test_dot_constraints),
+                ("test_sac", test_sac),
+                ("test_units", test_units),
+                ("test_box_shapes", test_box_shapes),
+                ("test_tensor", test_tensor),
+                ("test_tensor_batch", test_tensor_batch),
+                ("test_dlx_counts", test_dlx_counts)]
+
 if __name__ == "__main__":
 
     if test_model:
@@ -312,4 +998,21 @@ if __name__ == "__main__":
         score = test_ord_mrv_fun()
         print("\n\n********************************************\n")
         print("Total MRV tests passed: %d/1\n" % score)
-        print("********************************************\n")
\ No newline at end of file
+        print("********************************************\n")
+
+    if test_engines:
+        total = 0
+        print("\n\n********************************************\n")
+        print("ENGINE TESTS\n")
+        print("********************************************\n")
+
+        for name, test in engine_tests:
+            print("---starting %s---" % name)
+            score,details = test()
+            total += score
+            print(details)
+            print("---finished %s---\n" % name)
+
+        print("\n\n********************************************\n")
+        print("Total engine tests passed: %d/%d\n" % (total, len(engine_tests)))
+        print("********************************************\n")
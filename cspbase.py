@@ -1,4 +1,9 @@
+import random
+import sys
 import time
+from array import array
+from bisect import bisect_left
+from collections import deque
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -14,6 +19,12 @@ import time
       So one can remove values, add them back, and query if they are 
       still current. 
 
+      class BitVariable
+
+      A Variable with the same interface whose current domain is kept
+      as a single int bitmask, giving constant time membership tests
+      and domain sizes.
+
     B) class constraint
 
       This class allows one to define constraints specified by tables
@@ -29,10 +40,45 @@ import time
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
+      The tuples are kept in a TupleTable, a packed representation
+      using flat arrays of value numbers instead of Python tuples.
+      Constraints over the same relation (e.g., all binary NOT-EQUAL
+      constraints over the same domains) can share one interned table,
+      see get_relation.
+
+      class FunctionConstraint
+
+      A constraint defined intensionally by a check function (and
+      optionally a support finding function) instead of a table of
+      satisfying tuples. Useful when the table would be too large to
+      build, e.g., an all-different over 9 or more variables.
+
+      class AllDiffConstraint
+
+      A global all-different constraint. GAC on it is achieved in
+      polynomial time by bipartite matching (Regin's algorithm) rather
+      than by searching for supports.
+
     C) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
        executed depending on the propagator used.
 
+       class DomainSizeIndex
+
+       Bucket queue of the unassigned variables keyed on current domain
+       size, updated by the variables themselves, used for MRV ordering.
+
+       class Trail
+
+       Records every value pruned during search in one preallocated
+       stack, so that search can undo all prunings made since a saved
+       height (a choice point) in one call.
+
+       class NogoodStore
+
+       Nogoods (partial assignments known to have no solution) recorded
+       by restarting search, indexed by variable and unit propagated.
+
 '''
 
 
@@ -84,6 +130,11 @@ class Variable:
         self.curdom = [True] * len(domain)      #using list
         #for bt_search
         self.assignedValue = None
+        self.trail = None               #Trail recording prunings, if any
+        self.size_index = None          #DomainSizeIndex kept up to date, if any
+        #for backjumping (see BT.bt_search_cbj), bitmasks of decision levels
+        self.expl = 0                   #levels explaining the pruned values
+        self.asgn_expl = 0              #levels explaining the assignment
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
@@ -91,6 +142,21 @@ class Variable:
         for val in values: 
             self.dom.append(val)
             self.curdom.append(True)
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def reset_domain(self, domain):
+        '''Replace the (permanent) domain, unassigning the variable and
+           making every value current. Only for reusing a variable in a
+           new problem (see kropki_csp.KropkiTemplate), never during
+           search; constraints caching domain information should then
+           have clear_caches called.'''
+        self.assignedValue = None
+        if self.dom != domain:
+            self.dom = list(domain)
+        self.curdom = [True] * len(self.dom)
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -107,10 +173,16 @@ class Variable:
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
         self.curdom[self.value_index(value)] = False
+        if self.trail is not None:
+            self.trail.push(self, value)
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
         self.curdom[self.value_index(value)] = True
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
@@ -124,6 +196,24 @@ class Variable:
                     vals.append(val)
         return vals
 
+    def iter_cur_domain(self):
+        '''iterate over the values in CURRENT domain (without constructing 
+           list). Same values and order as cur_domain'''
+        if self.is_assigned():
+            yield self.get_assigned_value()
+        else:
+            for i, val in enumerate(self.dom):
+                if self.curdom[i]:
+                    yield val
+
+    def value_mask(self):
+        '''return the CURRENT domain as a bitmask indexed by value: bit v
+           is set for each value v (values must be non-negative ints)'''
+        mask = 0
+        for val in self.iter_cur_domain():
+            mask |= 1 << val
+        return mask
+
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
@@ -146,6 +236,8 @@ class Variable:
         '''return all values back into CURRENT domain'''
         for i in range(len(self.curdom)):
             self.curdom[i] = True
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     #
     #methods for assigning and unassigning
@@ -165,6 +257,8 @@ class Variable:
             return
 
         self.assignedValue = value
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -172,11 +266,21 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        if self.size_index is not None:
+            self.size_index.update(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
         return self.assignedValue
 
+    def explanation(self):
+        '''return the bitmask of the decision levels that explain the
+           variable's current domain: its prunings and, if assigned, its
+           assignment (see BT.bt_search_cbj)'''
+        if self.is_assigned():
+            return self.expl | self.asgn_expl
+        return self.expl
+
     #
     #internal methods
     #
@@ -197,6 +301,320 @@ class Variable:
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
                                                              self.curdom))
+class BitVariable(Variable):
+    '''Variable whose current domain is a single int used as a bitmask:
+       bit i is set if and only if self.dom[i] is still current. A dict
+       maps domain values to their index. This gives constant time
+       in_cur_domain and value_index, a popcount for cur_domain_size, and
+       iteration over the current domain without building a list.
+
+       The interface is the same as Variable's, and curdom is still
+       available (as a list of flags built on demand).'''
+
+    def __init__(self, name, domain=[]):
+        self.name = name
+        self.dom = list(domain)
+        self.index = dict()
+        for i, val in enumerate(self.dom):
+            self.index[val] = i
+        self.curmask = (1 << len(self.dom)) - 1
+        self.assignedValue = None
+        self.trail = None
+        self.size_index = None
+        self.expl = 0
+        self.asgn_expl = 0
+        self.set_shift()
+
+    @property
+    def curdom(self):
+        return [bool(self.curmask >> i & 1) for i in range(len(self.dom))]
+
+    def reset_domain(self, domain):
+        self.assignedValue = None
+        if self.dom != domain:
+            self.dom = list(domain)
+            self.index = dict()
+            for i, val in enumerate(self.dom):
+                self.index[val] = i
+            self.set_shift()
+        self.curmask = (1 << len(self.dom)) - 1
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def add_domain_values(self, values):
+        for val in values:
+            self.index[val] = len(self.dom)
+            self.curmask |= 1 << len(self.dom)
+            self.dom.append(val)
+        self.set_shift()
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def prune_value(self, value):
+        self.curmask &= ~(1 << self.index[value])
+        if self.trail is not None:
+            self.trail.push(self, value)
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def unprune_value(self, value):
+        self.curmask |= 1 << self.index[value]
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def cur_domain(self):
+        return list(self.iter_cur_domain())
+
+    def iter_cur_domain(self):
+        if self.is_assigned():
+            yield self.assignedValue
+        else:
+            dom = self.dom
+            mask = self.curmask
+            while mask:
+                low = mask & -mask
+                yield dom[low.bit_length() - 1]
+                mask ^= low
+
+    def in_cur_domain(self, value):
+        i = self.index.get(value)
+        if i == None:
+            return False
+        if self.is_assigned():
+            return value == self.assignedValue
+        return self.curmask >> i & 1 == 1
+
+    def cur_domain_size(self):
+        if self.is_assigned():
+            return 1
+        return self.curmask.bit_count()
+
+    def restore_curdom(self):
+        self.curmask = (1 << len(self.dom)) - 1
+        if self.size_index is not None:
+            self.size_index.update(self)
+
+    def value_index(self, value):
+        return self.index[value]
+
+    def set_shift(self):
+        '''Internal routine. If the domain is the consecutive ints lo, lo+1,
+           ... (lo >= 0) value_mask is curmask shifted by lo: self.shift = lo.
+           Otherwise self.shift is None'''
+        self.shift = None
+        if self.dom and isinstance(self.dom[0], int) and self.dom[0] >= 0 and \
+           self.dom == list(range(self.dom[0], self.dom[0] + len(self.dom))):
+            self.shift = self.dom[0]
+
+    def value_mask(self):
+        if self.is_assigned():
+            return 1 << self.assignedValue
+        if self.shift is not None:
+            return self.curmask << self.shift
+        return Variable.value_mask(self)
+
+
+class TupleTable:
+    '''Packed storage for a table of tuples of a fixed arity.
+
+       Each distinct value is given a number and the tuples are stored
+       row by row, as value numbers, in one flat array ('rows'). For
+       membership tests each row is also encoded as a single integer
+       (the value numbers as fixed width bit fields) kept in a sorted
+       array searched by bisection. For each position i of the tuples,
+       order[i] lists the row numbers sorted by the value at position i
+       and offsets[i][v] is where the rows with value number v start, so
+       the rows containing a value at a position are a contiguous range.
+
+       Tuples can be added at any time; the membership and support
+       indexes are (re)built the first time they are needed.
+       Duplicate tuples are only stored once.
+
+       A table does not refer to any variable, so one table can be
+       shared by many constraints (see get_relation).'''
+
+    def __init__(self, arity):
+        self.arity = arity
+        self.values = []            #value number -> value
+        self.value_ids = dict()     #value -> value number
+        self.rows = array('i')
+        self.nrows = 0
+        self.built = True
+        self.bits = 1               #width of a value number in a key
+        self.keys = array('q')      #sorted keys (or a set if too wide)
+        self.order = []
+        self.offsets = []
+        self.masks = None           #per position bitsets, see bitsets()
+
+    def add(self, tuples):
+        '''Add an iterable of tuples (or lists) of values'''
+        for x in tuples:
+            for val in x:
+                vid = self.value_ids.get(val)
+                if vid == None:
+                    vid = len(self.values)
+                    self.value_ids[val] = vid
+                    self.values.append(val)
+                self.rows.append(vid)
+        self.built = False
+        self.masks = None
+
+    def copy(self):
+        '''return a new table with the same tuples'''
+        table = TupleTable(self.arity)
+        table.values = list(self.values)
+        table.value_ids = dict(self.value_ids)
+        table.rows = array('i', self.rows)
+        table.built = False
+        return table
+
+    def build(self):
+        '''Internal routine. Drop duplicate rows and build the membership
+           and support indexes'''
+        a = self.arity
+        rows = self.rows
+        self.bits = max(1, (len(self.values) - 1).bit_length())
+        seen = set()
+        packed = array('i')
+        for r in range(len(rows) // a if a else 0):
+            key = self.encode(rows[r*a:(r+1)*a])
+            if not key in seen:
+                seen.add(key)
+                packed.extend(rows[r*a:(r+1)*a])
+        self.rows = packed
+        self.nrows = len(seen)
+        if self.bits * a < 64:
+            self.keys = array('q', sorted(seen))
+        else:
+            self.keys = seen
+        del seen
+
+        nvals = len(self.values)
+        self.order = []
+        self.offsets = []
+        for i in range(a):
+            offsets = array('i', [0]) * (nvals + 1)
+            for r in range(self.nrows):
+                offsets[packed[r*a+i] + 1] += 1
+            for v in range(nvals):
+                offsets[v+1] += offsets[v]
+            order = array('i', [0]) * self.nrows
+            nxt = offsets[:-1]
+            for r in range(self.nrows):
+                vid = packed[r*a+i]
+                order[nxt[vid]] = r
+                nxt[vid] += 1
+            self.order.append(order)
+            self.offsets.append(offsets)
+        self.built = True
+
+    def encode(self, vids):
+        '''Internal routine. Key of a row given its value numbers'''
+        key = 0
+        for vid in vids:
+            key = key << self.bits | vid
+        return key
+
+    def __len__(self):
+        if not self.built:
+            self.build()
+        return self.nrows
+
+    def contains(self, vals):
+        '''return True if the tuple of values vals is in the table'''
+        if not self.built:
+            self.build()
+        key = 0
+        for val in vals:
+            vid = self.value_ids.get(val)
+            if vid == None:
+                return False
+            key = key << self.bits | vid
+        if type(self.keys) is set:
+            return key in self.keys
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def support_range(self, i, val):
+        '''return (order, start, end): the rows with val at position i
+           are order[start:end]'''
+        if not self.built:
+            self.build()
+        vid = self.value_ids.get(val)
+        if vid == None:
+            return self.order[i], 0, 0
+        offsets = self.offsets[i]
+        return self.order[i], offsets[vid], offsets[vid+1]
+
+    def bitsets(self):
+        '''return, for each position, a dict mapping each value to the
+           bitset (an int) of the rows with that value at that position.
+           Computed once and shared by all constraints using the table'''
+        if not self.built:
+            self.build()
+        if self.masks == None:
+            self.masks = []
+            for i in range(self.arity):
+                order, offsets = self.order[i], self.offsets[i]
+                sup = dict()
+                for vid, val in enumerate(self.values):
+                    mask = 0
+                    for k in range(offsets[vid], offsets[vid+1]):
+                        mask |= 1 << order[k]
+                    if mask:
+                        sup[val] = mask
+                self.masks.append(sup)
+        return self.masks
+
+    def row(self, r):
+        '''return row r as a tuple of values'''
+        a = self.arity
+        return tuple(self.values[vid] for vid in self.rows[r*a:(r+1)*a])
+
+    def tuples(self):
+        '''Generate the tuples of the table'''
+        if not self.built:
+            self.build()
+        for r in range(self.nrows):
+            yield self.row(r)
+
+    def memory_bytes(self):
+        '''return the (approximate) number of bytes used by the table'''
+        n = sys.getsizeof(self) + sys.getsizeof(self.values) + \
+            sys.getsizeof(self.value_ids) + sys.getsizeof(self.rows) + \
+            sys.getsizeof(self.keys)
+        for arr in self.order + self.offsets:
+            n += sys.getsizeof(arr)
+        if self.masks != None:
+            for sup in self.masks:
+                n += sys.getsizeof(sup) + sum(sys.getsizeof(m) for m in sup.values())
+        return n
+
+
+#Interned relations, see get_relation
+relations = dict()
+
+def get_relation(kind, domains, tuples):
+    '''return the TupleTable interned under kind (a name for the
+       relation, e.g., "neq") and domains (one list of values for each
+       position). The first time a (kind, domains) pair is asked for the
+       table is built from tuples, a function of no arguments returning
+       the satisfying tuples; afterwards the same table is returned, so
+       the relation is stored and indexed once however many constraints
+       use it (see Constraint.set_relation).'''
+    key = (kind, tuple(tuple(dom) for dom in domains))
+    table = relations.get(key)
+    if table == None:
+        table = TupleTable(len(domains))
+        table.add(tuples())
+        relations[key] = table
+    return table
+
+def clear_relations():
+    '''Forget all interned relations'''
+    relations.clear()
+
+
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
@@ -214,34 +632,85 @@ class Constraint:
         in the scope such that this sequence of values satisfies the
         constraints).
 
-        NOTE: This is a very space expensive representation...a proper
-        constraint object would allow for representing the constraint
-        with a function.  
+        NOTE: This is a space expensive representation, even packed
+        in a TupleTable...see FunctionConstraint below for
+        representing the constraint with a function.  
         '''
 
         self.scope = list(scope)
         self.name = name
-        self.sat_tuples = dict()
 
-        #The next object data item 'sup_tuples' will be used to help
-        #support GAC propgation. It allows access to a list of 
-        #satisfying tuples that contain a particular variable/value
-        #pair.
-        self.sup_tuples = dict()
+        #The satisfying tuples. The table also gives access to the
+        #tuples that contain a particular value at a particular scope
+        #position, which is used to support GAC propagation.
+        self.table = TupleTable(len(self.scope))
+        self.shared_table = False   #table may be used by other constraints
+        self.positions = dict()
+        for i, var in enumerate(self.scope):
+            self.positions.setdefault(var, i)
+
+        #Number of times (plus one) the constraint caused a domain wipe
+        #out, used by the dom/wdeg variable ordering heuristic.
+        self.weight = 1
+
+        #Residual supports (AC-3rm): the last supporting row found for
+        #each (variable, value) pair, checked first by has_support. A
+        #residue is only a hint that is re-validated against the current
+        #domains, so it stays correct when values are restored on
+        #backtracking.
+        self.residues = dict()
+        self.residue_checks = 0
+        self.residue_hits = 0
+
+        #Compact-Table data, set up by use_compact_table: for each scope
+        #position a dict mapping each value to the bitset (an int) of
+        #the tuples containing it, and the last (domain state, union of
+        #bitsets) computed for each position.
+        self.ct_supports = None
+        self.ct_cache = None
 
     def add_satisfying_tuples(self, tuples):
         '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
-
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+        if self.shared_table:
+            #copy on write: never change a table other constraints use
+            self.table = self.table.copy()
+            self.shared_table = False
+        self.table.add(tuples)
+        self.residues.clear()
+
+        if self.ct_supports != None:
+            #rebuild the compact table with the new tuples
+            self.use_compact_table()
+
+    def set_relation(self, table):
+        '''Specify the constraint by a TupleTable (usually shared with
+           other constraints, see get_relation) instead of adding its
+           tuples. The table must have the arity of the scope'''
+        if table.arity != len(self.scope):
+            print("ERROR: relation of arity", table.arity, "for constraint", self)
+            return
+        self.table = table
+        self.shared_table = True
+        self.residues.clear()
+        if self.ct_supports != None:
+            self.use_compact_table()
+
+    @property
+    def sat_tuples(self):
+        '''dict with the satisfying tuples as keys, built from the table
+           (expensive: for inspection only)'''
+        return dict.fromkeys(self.table.tuples(), True)
+
+    @property
+    def sup_tuples(self):
+        '''dict mapping (var, val) to the list of satisfying tuples with
+           val for var, built from the table (expensive: for inspection
+           only)'''
+        sup = dict()
+        for t in self.table.tuples():
+            for var, val in zip(self.scope, t):
+                sup.setdefault((var, val), []).append(t)
+        return sup
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -254,7 +723,7 @@ class Constraint:
            constraints "satisfies" function.  Note the list of values
            are must be ordered in the same order as the list of
            variables in the constraints scope'''
-        return tuple(vals) in self.sat_tuples
+        return self.table.contains(vals)
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
@@ -273,31 +742,446 @@ class Constraint:
                 vs.append(v)
         return vs
 
+    def explanation(self, var=None):
+        '''return the bitmask of the decision levels explaining the
+           current domains of the constraint's variables (other than var).
+           These explain any value the constraint prunes from var, and
+           any wipe out it causes (with var None)'''
+        expl = 0
+        for v in self.scope:
+            if v is not var:
+                expl |= v.explanation()
+        return expl
+
     def has_support(self, var, val):
         '''Test if a variable value pair has a supporting tuple (a set
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
+        i = self.positions.get(var)
+        if i == None:
+            return False
+        if self.ct_supports != None:
+            return self.ct_supports[i].get(val, 0) & self.ct_valid() != 0
+        r = self.residues.get((var, val))
+        if r != None:
+            self.residue_checks += 1
+            if self.row_is_valid(r):
+                self.residue_hits += 1
+                return True
+        order, start, end = self.table.support_range(i, val)
+        for k in range(start, end):
+            r = order[k]
+            if self.row_is_valid(r):
+                #row r supports every value in it (multidirectionality)
+                for var, v in zip(self.scope, self.table.row(r)):
+                    self.residues[(var, v)] = r
+                return True
         return False
 
+    def clear_caches(self):
+        '''Forget residual supports and cached domain information, e.g.,
+           after the domains of the scope variables were reset'''
+        self.residues.clear()
+        if self.ct_supports != None:
+            self.ct_cache = [(None, 0)] * len(self.scope)
+
+    def residue_stats(self):
+        '''return (checks, hits): how often has_support tried a residual
+           support and how often it was still valid'''
+        return self.residue_checks, self.residue_hits
+
+    def unsupported_values(self):
+        '''Return the (var, val) pairs, var an unassigned variable in the
+           scope, such that val is in var's current domain but has no
+           support. Used by GAC; subclasses can override it with a
+           specialised filtering algorithm.'''
+        if self.ct_supports != None:
+            return self.ct_unsupported()
+        return self.scan_unsupported()
+
+    def scan_unsupported(self):
+        '''Internal routine. Generate the unsupported values by calling
+           has_support on each. Each pair is tested as it is generated,
+           so values pruned by the caller while iterating are taken into
+           account'''
+        for var in self.scope:
+            if not var.is_assigned():
+                for d in var.iter_cur_domain():
+                    if not self.has_support(var, d):
+                        yield var, d
+
+    def use_compact_table(self):
+        '''Switch the constraint to Compact-Table filtering. Each tuple
+           gets a bit; each (variable, value) pair gets the bitset of the
+           tuples it appears in. The bitset of valid tuples is then the
+           AND over the scope of the OR of the bitsets of the current
+           values, and a value is supported iff its bitset meets it.
+           Python ints make these word-parallel operations.
+
+           The bitsets are recomputed from the variables' domains rather
+           than updated and restored by search, but the OR for a scope
+           position is reused while that variable's domain is unchanged.
+           Return False if the constraint has no tuples.'''
+        if len(self.table) == 0:
+            return False
+        #row r of the table is bit r
+        self.ct_supports = self.table.bitsets()
+        self.ct_cache = [(None, 0)] * len(self.scope)
+        return True
+
+    def ct_valid(self):
+        '''Internal routine. Return the bitset of tuples whose values are
+           all in the current domains'''
+        valid = -1
+        for i, var in enumerate(self.scope):
+            if var.is_assigned():
+                state = ('=', var.get_assigned_value())
+            else:
+                state = getattr(var, 'curmask', None)
+            cached_state, mask = self.ct_cache[i]
+            if state == None or state != cached_state:
+                mask = 0
+                sup = self.ct_supports[i]
+                for d in var.iter_cur_domain():
+                    mask |= sup.get(d, 0)
+                if state != None:
+                    self.ct_cache[i] = (state, mask)
+            valid &= mask
+            if not valid:
+                break
+        return valid
+
+    def ct_unsupported(self):
+        '''Internal routine. Return the list of unsupported values using
+           the compact table'''
+        valid = self.ct_valid()
+        pruned = []
+        for i, var in enumerate(self.scope):
+            if not var.is_assigned():
+                sup = self.ct_supports[i]
+                for d in var.iter_cur_domain():
+                    if not sup.get(d, 0) & valid:
+                        pruned.append((var, d))
+        return pruned
+
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
-        for i, var in enumerate(self.scope):
-            if not var.in_cur_domain(t[i]):
+        for var, val in zip(self.scope, t):
+            if not var.in_cur_domain(val):
                 return False
         return True
 
+    def row_is_valid(self, r):
+        '''Internal routine. Check if every value in row r of the table
+           is still in corresponding variable domains'''
+        table = self.table
+        values = table.values
+        base = r * table.arity
+        for var, vid in zip(self.scope, table.rows[base:base+table.arity]):
+            if not var.in_cur_domain(values[vid]):
+                return False
+        return True
+
+    def memory_bytes(self, seen=None):
+        '''return the (approximate) number of bytes used by the
+           constraint. Objects whose id is in the set seen are not
+           counted again'''
+        if seen == None:
+            seen = set()
+        n = sys.getsizeof(self) + sys.getsizeof(self.scope) + \
+            sys.getsizeof(self.positions) + sys.getsizeof(self.residues)
+        if not id(self.table) in seen:
+            seen.add(id(self.table))
+            n += self.table.memory_bytes()
+        return n
+
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
     def print_all(self):
-        print("{}({}):{}".format(self.name,[var.name for var in self.scope],self.sat_tuples))
+        print("{}({}):{}".format(self.name,[var.name for var in self.scope],list(self.table.tuples())))
+
+class FunctionConstraint(Constraint):
+    '''Constraint defined by a check function rather than by a table of
+       satisfying tuples. No tuples are stored, so the memory used by the
+       constraint does not depend on the size of its domains.
+
+       check_fn(vals) is given a list of values, one for each variable in
+       the scope (in scope order), and returns True if and only if the
+       values satisfy the constraint.
+
+       support_fn(constraint, var, val) is optional. If given it must
+       return True if and only if var=val can be extended to a
+       satisfying assignment using only values in the CURRENT domains of
+       the other variables in the scope. If it is not given has_support
+       searches the current domains of the other variables, checking
+       each complete assignment with check_fn. That search is exponential
+       in the arity of the constraint, so a support_fn should be given
+       for large scopes.'''
+
+    def __init__(self, name, scope, check_fn, support_fn=None):
+        Constraint.__init__(self, name, scope)
+        self.check_fn = check_fn
+        self.support_fn = support_fn
+
+    def add_satisfying_tuples(self, tuples):
+        '''Function constraints are not specified by tuples'''
+        print("ERROR: trying to add satisfying tuples to function constraint", self)
+
+    def check(self, vals):
+        return bool(self.check_fn(list(vals)))
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting assignment of
+           values from the current domains of the other variables'''
+        if not var in self.scope:
+            return False
+        if self.support_fn:
+            return self.support_fn(self, var, val)
+        vals = [None] * len(self.scope)
+        fixed = self.scope.index(var)
+        vals[fixed] = val
+        return self.extend_support(vals, fixed, 0)
+
+    def extend_support(self, vals, fixed, i):
+        '''Internal routine. Extend the partial assignment vals[0..i-1]
+           with values from the current domains of scope[i..] (leaving
+           position fixed alone) until it satisfies the constraint'''
+        if i == len(self.scope):
+            return self.check(vals)
+        if i == fixed:
+            return self.extend_support(vals, fixed, i+1)
+        for d in self.scope[i].cur_domain():
+            vals[i] = d
+            if self.extend_support(vals, fixed, i+1):
+                return True
+        return False
+
+    def print_all(self):
+        print("{}({}):{}".format(self.name,[var.name for var in self.scope],
+                                 getattr(self.check_fn, '__name__', self.check_fn)))
+
+
+
+
+class AllDiffConstraint(Constraint):
+    '''Constraint requiring all variables in its scope to take
+       different values. No tuples are stored.
 
+       GAC is enforced with Regin's algorithm: find a maximum matching
+       between the variables and the values of their current domains,
+       then a value is supported if and only if its edge belongs to
+       some maximum matching, i.e., it is in the matching, on an
+       alternating cycle (same strongly connected component), or on an
+       alternating path starting at a free value.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        #last matching found, used as the starting point of the next one
+        self.matching = [None] * len(self.scope)
+
+    def add_satisfying_tuples(self, tuples):
+        '''All-different constraints are not specified by tuples'''
+        print("ERROR: trying to add satisfying tuples to all-different constraint", self)
+
+    def check(self, vals):
+        vals = list(vals)
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        '''Test if var=val can be extended to an assignment of distinct
+           values from the current domains of the other variables'''
+        if not var in self.scope or not var.in_cur_domain(val):
+            return False
+        doms = [[val] if v is var else v.cur_domain() for v in self.scope]
+        return self.find_matching(doms) != None
+
+    def unsupported_values(self):
+        '''Return the list of (var, val) pairs, var an unassigned variable
+           in the scope, such that val is in var's current domain but
+           var=val is in no maximum matching. If no complete matching
+           exists every value of an unassigned variable is returned.'''
+        n = len(self.scope)
+        doms = [var.cur_domain() for var in self.scope]
+        match = self.find_matching(doms)
+        if match == None:
+            for var in self.scope:
+                if not var.is_assigned():
+                    return [(var, d) for d in var.cur_domain()]
+            return []
+
+        #Directed graph: variable nodes 0..n-1 point to their matched
+        #value, value nodes n.. point to the variables that could take
+        #them but are not matched to them.
+        val_node = dict()
+        for dom in doms:
+            for d in dom:
+                if not d in val_node:
+                    val_node[d] = n + len(val_node)
+        succ = [[val_node[match[i]]] for i in range(n)]
+        succ.extend([] for _ in range(len(val_node)))
+        for i, dom in enumerate(doms):
+            for d in dom:
+                if d != match[i]:
+                    succ[val_node[d]].append(i)
+
+        #edges on an alternating path from a free value
+        matched = set(val_node[d] for d in match)
+        reach = [node for node in val_node.values() if not node in matched]
+        seen = set(reach)
+        while reach:
+            node = reach.pop()
+            for nxt in succ[node]:
+                if not nxt in seen:
+                    seen.add(nxt)
+                    reach.append(nxt)
+
+        comp = self.strongly_connected(succ)
+        pruned = []
+        for i, var in enumerate(self.scope):
+            if var.is_assigned():
+                continue
+            for d in doms[i]:
+                node = val_node[d]
+                if d != match[i] and not node in seen and comp[node] != comp[i]:
+                    pruned.append((var, d))
+        return pruned
+
+    def clear_caches(self):
+        Constraint.clear_caches(self)
+        self.matching = [None] * len(self.scope)
+
+    def find_matching(self, doms):
+        '''Internal routine. Return a list giving each scope position a
+           distinct value from doms (a list of value lists, one for each
+           scope variable) or None if there is no such matching. The
+           previous matching is reused where it is still valid.'''
+        match = [None] * len(doms)
+        owner = dict()
+        for i, d in enumerate(self.matching):
+            if d != None and d in doms[i] and not d in owner:
+                match[i] = d
+                owner[d] = i
+        for i in range(len(doms)):
+            if match[i] == None and not self.augment(i, doms, match, owner, set()):
+                return None
+        self.matching = match
+        return match
+
+    def augment(self, i, doms, match, owner, visited):
+        '''Internal routine. Find an augmenting path from scope position
+           i, updating match and owner (value -> position) along it'''
+        for d in doms[i]:
+            if d in visited:
+                continue
+            visited.add(d)
+            if not d in owner or self.augment(owner[d], doms, match, owner, visited):
+                match[i] = d
+                owner[d] = i
+                return True
+        return False
+
+    def strongly_connected(self, succ):
+        '''Internal routine. Tarjan's algorithm; return a list giving the
+           strongly connected component number of each node'''
+        index = [None] * len(succ)
+        low = [0] * len(succ)
+        comp = [None] * len(succ)
+        stack = []
+        on_stack = [False] * len(succ)
+        counter = [0, 0]   #next index, next component
+
+        def visit(v):
+            index[v] = low[v] = counter[0]
+            counter[0] += 1
+            stack.append(v)
+            on_stack[v] = True
+            for w in succ[v]:
+                if index[w] == None:
+                    visit(w)
+                    low[v] = min(low[v], low[w])
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+            if low[v] == index[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    comp[w] = counter[1]
+                    if w == v:
+                        break
+                counter[1] += 1
+
+        for v in range(len(succ)):
+            if index[v] == None:
+                visit(v)
+        return comp
+
+    def print_all(self):
+        print("{}({}):AllDiff".format(self.name,[var.name for var in self.scope]))
+
+
+class DomainSizeIndex:
+    '''Bucket queue of the unassigned variables of a CSP ordered by
+       current domain size, ties broken in favour of the variable in
+       the most constraints. Variables call update whenever their
+       current domain or assignment changes, so the index never has to
+       rescan the CSP; select returns a variable with the smallest key
+       in amortized constant time.
+
+       The key of a variable is size * stride + (maxdeg - degree), so a
+       single array of buckets orders by size and then degree.'''
+
+    def __init__(self, csp):
+        self.degree = dict()
+        for v in csp.vars:
+            self.degree[v] = csp.get_degree(v)
+        self.maxdeg = max(self.degree.values(), default=0)
+        self.stride = self.maxdeg + 1
+        self.buckets = []
+        self.key = dict()   #key of each variable in the index
+        self.min = 0        #no bucket below min is non-empty
+        for v in csp.vars:
+            v.size_index = self
+            self.update(v)
+
+    def update(self, var):
+        '''Move var to the bucket for its current domain size (or remove
+           it if it is assigned)'''
+        old = self.key.get(var)
+        if var.is_assigned():
+            new = None
+        else:
+            new = var.cur_domain_size() * self.stride + self.maxdeg - self.degree[var]
+        if old == new:
+            return
+        if old != None:
+            del self.buckets[old][var]
+            del self.key[var]
+        if new != None:
+            while len(self.buckets) <= new:
+                self.buckets.append(dict())
+            self.buckets[new][var] = True
+            self.key[var] = new
+            if new < self.min:
+                self.min = new
+
+    def select(self, rng=None):
+        '''Return an unassigned variable with minimum domain size (and
+           maximum degree among those), None if all are assigned. If rng
+           (a random.Random) is given ties are broken at random'''
+        while self.min < len(self.buckets):
+            bucket = self.buckets[self.min]
+            if bucket:
+                if rng is not None and len(bucket) > 1:
+                    return rng.choice(list(bucket))
+                return next(iter(bucket))
+            self.min += 1
+        return None
+
+    def __len__(self):
+        return len(self.key)
 
 
 class CSP:
@@ -314,24 +1198,36 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        self.trail = None
+        self.size_index = None
+        self.last_conflict = None   #constraint that caused the last wipe out
+        self.rng = None             #random.Random used by the orderings to break
+                                    #ties, None for deterministic orderings
+        self.units = []             #see add_unit
+        self.var_units = dict()
+        self.unit_implied = set()
+        self.unit_cons = dict()     #unit -> the constraints it implies
         for v in vars:
             self.add_var(v)
 
     def add_var(self,v):
         '''Add variable object to CSP while setting up an index
            to obtain the constraints over this variable'''
-        if not type(v) is Variable:
+        if not isinstance(v, Variable):
             print("Trying to add non variable ", v, " to CSP object")
         elif v in self.vars_to_cons:
             print("Trying to add variable ", v, " to CSP object that already has it")
         else:
             self.vars.append(v)
             self.vars_to_cons[v] = []
+            v.trail = self.trail
+            if self.size_index is not None:
+                self.attach_size_index()
 
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
@@ -340,6 +1236,85 @@ class CSP:
                     return
                 self.vars_to_cons[v].append(c)
             self.cons.append(c)
+            if self.size_index is not None:
+                self.attach_size_index()
+
+    def remove_constraints(self, cons):
+        '''Remove the constraints in cons from the CSP'''
+        gone = set(cons)
+        if not gone:
+            return
+        self.cons = [c for c in self.cons if not c in gone]
+        for v in set(v for c in gone for v in c.scope):
+            self.vars_to_cons[v] = [c for c in self.vars_to_cons[v] if not c in gone]
+        if self.size_index is not None:
+            self.attach_size_index()
+
+    def attach_trail(self, trail):
+        '''Record all prunings of the CSP's variables on trail. Pass None
+           to stop recording'''
+        self.trail = trail
+        for v in self.vars:
+            v.trail = trail
+
+    def detach_trail(self):
+        self.attach_trail(None)
+
+    def attach_size_index(self):
+        '''Build a DomainSizeIndex over the variables and keep it up to
+           date as they are pruned, restored, assigned and unassigned'''
+        self.size_index = DomainSizeIndex(self)
+        return self.size_index
+
+    def reset_weights(self):
+        '''Reset the conflict weights of all constraints (see dom/wdeg)'''
+        for c in self.cons:
+            c.weight = 1
+        self.last_conflict = None
+
+    def residue_stats(self):
+        '''return (checks, hits) of residual supports summed over all
+           constraints (see Constraint.residue_stats)'''
+        checks, hits = 0, 0
+        for c in self.cons:
+            c_checks, c_hits = c.residue_stats()
+            checks, hits = checks + c_checks, hits + c_hits
+        return checks, hits
+
+    def print_residue_stats(self):
+        checks, hits = self.residue_stats()
+        print("Residual supports: {} checks, {} hits ({:.1f}%)".format(
+            checks, hits, 100.0 * hits / checks if checks else 0.0))
+
+    def use_compact_tables(self):
+        '''Switch every table constraint of the CSP to Compact-Table
+           filtering (see Constraint.use_compact_table)'''
+        for c in self.cons:
+            c.use_compact_table()
+
+    def memory_bytes(self):
+        '''return the (approximate) number of bytes used by the
+           variables and constraints of the CSP'''
+        seen = set()
+        n = sys.getsizeof(self.vars) + sys.getsizeof(self.cons) + \
+            sys.getsizeof(self.vars_to_cons)
+        for v in self.vars:
+            n += sys.getsizeof(v) + sys.getsizeof(v.dom) + sys.getsizeof(self.vars_to_cons[v])
+        for c in self.cons:
+            n += c.memory_bytes(seen)
+        return n
+
+    def detach_size_index(self):
+        '''Stop maintaining the DomainSizeIndex (ord_mrv builds a new one
+           when it is next called)'''
+        self.size_index = None
+        for v in self.vars:
+            v.size_index = None
+
+    def get_degree(self, var):
+        '''return the number of constraints that include var in their
+           scope (without copying the list)'''
+        return len(self.vars_to_cons[var])
 
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
@@ -349,6 +1324,26 @@ class CSP:
         '''return list of constraints that include var in their scope'''
         return list(self.vars_to_cons[var])
 
+    def add_unit(self, unit, implied=()):
+        '''Declare a unit: a group of variables that take every value of
+           their domain exactly once (as many values as variables, all
+           different), e.g., a row of a Sudoku-like grid. unit is a
+           constraint over the group (usually an AllDiffConstraint, not
+           necessarily one of the CSP's constraints), implied are the
+           CSP's constraints that hold whenever the unit does (e.g., the
+           binary NOT-EQUALs inside the group). Units are used by
+           prop_UNITS, which then does not propagate the implied
+           constraints.'''
+        self.units.append(unit)
+        for v in unit.scope:
+            self.var_units.setdefault(v, []).append(unit)
+        self.unit_implied.update(implied)
+        self.unit_cons[unit] = list(implied)
+
+    def get_units_with_var(self, var):
+        '''return list of units (see add_unit) that include var'''
+        return list(self.var_units.get(var, ()))
+
     def get_all_unasgn_vars(self):
         '''return list of unassigned variables in the CSP'''
         return [v for v in self.vars if not v.is_assigned()]
@@ -376,6 +1371,129 @@ class CSP:
 # Backtracking Routine                                 #
 ########################################################
 
+class Trail:
+    '''Stack of (Variable, value) prunings. Variables attached to a
+       trail (see CSP.attach_trail) push every value they prune onto it.
+       Search saves the height of the trail (mark) before propagating and
+       undoes every pruning made since by resetting to that height
+       (undo). The stack is preallocated; a value is pruned at most once
+       on any search path, so the sum of the domain sizes is always
+       enough space.'''
+
+    def __init__(self, size=1024):
+        self.vars = [None] * max(size, 1)
+        self.vals = [None] * max(size, 1)
+        self.expls = [0] * max(size, 1)
+        self.top = 0
+        #when explaining, each pruning adds reason (a bitmask of decision
+        #levels, -1 for all levels) to the pruned variable's expl
+        self.explaining = False
+        self.reason = -1
+
+    def push(self, var, val):
+        '''Record that val was pruned from var'''
+        if self.top == len(self.vars):
+            self.vars.extend([None] * len(self.vars))
+            self.vals.extend([None] * len(self.vals))
+            self.expls.extend([0] * len(self.expls))
+        self.vars[self.top] = var
+        self.vals[self.top] = val
+        if self.explaining:
+            self.expls[self.top] = var.expl
+            var.expl |= self.reason
+        self.top += 1
+
+    def mark(self):
+        '''Return the current height of the trail'''
+        return self.top
+
+    def undo(self, mark):
+        '''Restore every value pruned since the trail had height mark'''
+        vars, vals = self.vars, self.vals
+        top = self.top
+        while top > mark:
+            top -= 1
+            vars[top].unprune_value(vals[top])
+            if self.explaining:
+                vars[top].expl = self.expls[top]
+        self.top = top
+
+    def prunings_since(self, mark):
+        '''Return the list of (Variable, value) pairs pruned since the
+           trail had height mark, i.e., the list a propagator would have
+           returned'''
+        return list(zip(self.vars[mark:self.top], self.vals[mark:self.top]))
+
+
+class NogoodStore:
+    '''A set of nogoods: each nogood is a tuple of (Variable, value)
+       pairs that no solution of the CSP extends. Nogoods are indexed by
+       their variables and unit propagated after each assignment.'''
+
+    def __init__(self):
+        self.nogoods = []
+        self.units = []      #nogoods of a single pair, i.e., refuted values
+        self.watch = dict()  #variable -> list of the nogoods it is in
+
+    def add(self, nogood):
+        '''Record the nogood (an iterable of (Variable, value) pairs)'''
+        nogood = tuple(nogood)
+        self.nogoods.append(nogood)
+        if len(nogood) == 1:
+            self.units.append(nogood[0])
+        for var, val in nogood:
+            self.watch.setdefault(var, []).append(nogood)
+
+    def __len__(self):
+        return len(self.nogoods)
+
+    def propagate(self, var):
+        '''var has just been assigned. Prune the last value of each nogood
+           over var whose other pairs all hold. Return False if a nogood
+           holds completely or a variable's domain is wiped out'''
+        for nogood in self.watch.get(var, ()):
+            unit = None
+            for x, a in nogood:
+                if x.is_assigned():
+                    if x.get_assigned_value() != a:
+                        break         #nogood cannot hold
+                elif unit is None and x.in_cur_domain(a):
+                    unit = (x, a)
+                else:
+                    break             #a second open pair, or one that cannot hold
+            else:
+                if unit is None:
+                    return False
+                x, a = unit
+                x.prune_value(a)
+                if x.cur_domain_size() == 0:
+                    return False
+        return True
+
+    def prune_units(self):
+        '''Prune the values refuted by unit nogoods. Return (status, n):
+           status is False if a domain is wiped out, n is the number of
+           values pruned'''
+        n = 0
+        for var, val in self.units:
+            if not var.is_assigned() and var.in_cur_domain(val):
+                var.prune_value(val)
+                n = n + 1
+                if var.cur_domain_size() == 0:
+                    return False, n
+        return True, n
+
+
+def luby(i):
+    '''return the i-th term (i >= 1) of the Luby sequence 1,1,2,1,1,2,4,1,...'''
+    k = 1
+    while (1 << k) - 1 < i:
+        k = k + 1
+    if i == (1 << k) - 1:
+        return 1 << (k - 1)
+    return luby(i - (1 << (k - 1)) + 1)
+
+
 class BT:
     '''use a class to encapsulate things like statistics
        and bookeeping for pruning/unpruning variabel domains
@@ -392,9 +1510,18 @@ class BT:
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
+        self.nSolutions = 0 #nSolutions is the number of solutions found by bt_solutions
         unasgn_vars = list() #used to track unassigned variables
         self.TRACE = False
-        self.runtime = 0
+        self.QUIET = False  #if True bt_search prints nothing
+        self.runtime = 0    #CPU time used by the last search
+        self.trail = None #Trail of prunings, created by bt_search
+        self.nRestarts = 0 #nRestarts is the number of restarts of bt_search_restarts
+        self.nogoods = None #NogoodStore of the last bt_search_restarts
+        self.path = []      #decisions of the current bt_search_restarts run
+        self.nBackjumps = 0 #nBackjumps is the number of levels skipped by bt_search_cbj
+        self.preprocess = None #if not None, a propagator run once at the root
+                               #after the initial propagation (e.g., prop_SAC)
 
     def trace_on(self):
         '''Turn search trace on'''
@@ -404,11 +1531,22 @@ class BT:
         '''Turn search trace off'''
         self.TRACE = False
 
+    def quiet_on(self):
+        '''Stop bt_search from printing its result and statistics'''
+        self.QUIET = True
+
+    def quiet_off(self):
+        '''Let bt_search print its result and statistics'''
+        self.QUIET = False
+
         
     def clear_stats(self):
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nSolutions = 0
+        self.nRestarts = 0
+        self.nBackjumps = 0
         self.runtime = 0
 
     def print_stats(self):
@@ -432,43 +1570,76 @@ class BT:
         '''Add variable back to list of unassigned vars'''
         self.unasgn_vars.append(var)
         
-    def bt_search(self,propagator,var_ord=None,val_ord=None):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
-
+    def start_search(self, propagator):
+        '''Internal routine. Clear the statistics, restore all domains,
+           attach a fresh Trail and do the initial propagation (and the
+           preprocessing, if any). Return the propagator's status'''
         self.clear_stats()
-        stime = time.process_time()
-
         self.restore_all_variable_domains()
+        self.csp.reset_weights()
         
         self.unasgn_vars = []
         for v in self.csp.vars:
             if not v.is_assigned():
                 self.unasgn_vars.append(v)
 
+        self.trail = Trail(sum(v.domain_size() for v in self.csp.vars))
+        self.csp.attach_trail(self.trail)
+
         status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
+        if status != False and self.preprocess != None:
+            status, prunings = self.preprocess(self.csp)
+        self.nPrunings = self.nPrunings + self.trail.mark()
 
         if self.TRACE:
             print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
+            print("Root Prunings: ", self.trail.prunings_since(0))
+        return status
+
+    def finish_search(self):
+        '''Internal routine. Undo all prunings and detach the trail'''
+        self.trail.undo(0)
+        self.csp.detach_trail()
 
+    def bt_search(self,propagator,var_ord=None,val_ord=None):
+        '''Return true if found solution. False if still need to search.
+           If top level returns false--> no solution
+
+           On success the variables are left assigned to the solution.
+           The CPU time used is left in self.runtime.
+
+           Prunings are recorded on a Trail attached to the CSP, so
+           propagators that prune with Variable.prune_value need not
+           return them (propagators returning the list of prunings, as
+           described in propagators.py, still work: the list is ignored)'''
+
+        stime = time.process_time()
+        status = self.start_search(propagator)
         if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
+            if not self.QUIET:
+                print("CSP{} detected contradiction at root".format(
+                    self.csp.name))
         else:
             status = self.bt_recurse(propagator, var_ord, val_ord, 1)   #now do recursive search
 
 
-        self.restoreValues(prunings)
+        self.finish_search()
+        self.runtime = time.process_time() - stime
+        self.print_result(status, "bt_search")
+        return status
+
+    def print_result(self, status, search):
+        '''Print the outcome and statistics of a search (unless QUIET)'''
+        if self.QUIET:
+            return
         if status == False:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
         if status == True:
             print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
-                                                             time.process_time() - stime))
+                                                             self.runtime))
             self.csp.print_soln()
 
-        print("bt_search finished")
+        print("{} finished".format(search))
         self.print_stats()
 
     def bt_recurse(self, propagator, var_ord, val_ord, level):
@@ -503,26 +1674,390 @@ class BT:
                 if self.TRACE:
                     print('  ' * level, "bt_recurse trying", var, "=", val)
 
+                mark = self.trail.mark()
                 var.assign(val)
                 self.nDecisions = self.nDecisions+1
 
                 status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+                self.nPrunings = self.nPrunings + self.trail.mark() - mark
 
                 if self.TRACE:
                     print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+                    print('  ' * level, "bt_recurse prop pruned = ", self.trail.prunings_since(mark))
 
                 if status:
                     if self.bt_recurse(propagator, var_ord,val_ord, level+1):
                         return True
 
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
+                    print('  ' * level, "bt_recurse restoring ", self.trail.prunings_since(mark))
+                self.trail.undo(mark)
                 var.unassign()
 
             self.restoreUnasgnVar(var)
             return False
 
+    def bt_solutions(self, propagator, var_ord=None, val_ord=None, limit=None):
+        '''Generate the solutions of the CSP, each as a dict mapping every
+           Variable to its value, stopping after limit solutions if
+           limit is not None.
+
+           All the solutions come from one search: after a solution is
+           generated the search resumes from where it was, keeping the
+           trail and the propagator state. While the generator is
+           suspended the variables are assigned to the last solution.
+           Closing the generator early (or exhausting it) undoes all
+           prunings. self.nSolutions, self.nDecisions, self.nPrunings and
+           self.runtime cover the search so far. Nothing is printed.'''
+
+        if limit is not None and limit <= 0:
+            return
+        stime = time.process_time()
+        try:
+            if self.start_search(propagator) == False:
+                return
+            for level in self.bt_recurse_all(propagator, var_ord, val_ord, 1):
+                self.nSolutions = self.nSolutions + 1
+                self.runtime = time.process_time() - stime
+                yield {var: var.get_assigned_value() for var in self.csp.vars}
+                stime = time.process_time() - self.runtime
+                if self.nSolutions == limit:
+                    return
+        finally:
+            self.finish_search()
+            self.runtime = time.process_time() - stime
+
+    def count_solutions(self, propagator, var_ord=None, val_ord=None, limit=None):
+        '''Return the number of solutions of the CSP, counting no further
+           than limit if limit is not None. limit=2 is a fast uniqueness
+           check: the CSP has exactly one solution iff the result is 1.'''
+        for soln in self.bt_solutions(propagator, var_ord, val_ord, limit):
+            pass
+        return self.nSolutions
+
+    def bt_recurse_all(self, propagator, var_ord, val_ord, level):
+        '''Generator version of bt_recurse: yield (the level) each time
+           all the variables are assigned, then carry on searching'''
+
+        if not self.unasgn_vars:
+            yield level
+            return
+
+        if var_ord:
+            var = var_ord(self.csp)
+        else:
+            var = self.unasgn_vars[0]
+        self.unasgn_vars.remove(var)
+
+        if val_ord:
+            value_order = val_ord(self.csp,var)
+        else:
+            value_order = var.cur_domain()
+
+        for val in value_order:
+            mark = self.trail.mark()
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+
+            status, prunings = propagator(self.csp, var)
+            self.nPrunings = self.nPrunings + self.trail.mark() - mark
+
+            if status:
+                yield from self.bt_recurse_all(propagator, var_ord, val_ord, level+1)
+
+            self.trail.undo(mark)
+            var.unassign()
+
+        self.restoreUnasgnVar(var)
+
+    def bt_subproblems(self, propagator, var_ord=None, val_ord=None, depth=1):
+        '''Generate the subproblems at the top depth branching levels of
+           the search tree, each as a list of (Variable, value) pairs: the
+           assignments leading to it. Assignments to variables with a
+           single value left do not count as a level. Branches the
+           propagator refutes are left out, so the subproblems partition
+           the solutions: every solution of the CSP extends exactly one
+           of them, and they can be searched independently (e.g., by
+           different processes).'''
+
+        try:
+            if self.start_search(propagator) == False:
+                return
+            yield from self.bt_recurse_split(propagator, var_ord, val_ord, depth, [])
+        finally:
+            self.finish_search()
+
+    def bt_frontier(self, propagator, var_ord=None, val_ord=None, min_nodes=1, max_depth=6):
+        '''Generate subproblems like bt_subproblems, but splitting the
+           tree breadth first, one node at a time, until there are at least
+           min_nodes subproblems or the open nodes are max_depth branching
+           levels deep. Each node is expanded by replaying its assignments
+           from the root, so the levels above it are not searched again.
+           Subproblems with nothing left to branch on are generated as soon
+           as they are found, the open nodes at the end.'''
+
+        try:
+            if self.start_search(propagator) == False:
+                return
+            root = self.trail.mark()
+            frontier = deque([(0, [])])     #(branching levels, path) of the open nodes
+            done = 0
+            while frontier and len(frontier) + done < min_nodes and frontier[0][0] < max_depth:
+                level, path = frontier.popleft()
+                for var, val in path:
+                    self.unasgn_vars.remove(var)
+                    var.assign(val)
+                    propagator(self.csp, var)
+                children = list(self.bt_recurse_split(propagator, var_ord, val_ord, 1, list(path)))
+                self.trail.undo(root)
+                for var, val in reversed(path):
+                    var.unassign()
+                    self.restoreUnasgnVar(var)
+                for child in children:
+                    if len(child) == len(path):
+                        #nothing left to branch on
+                        done = done + 1
+                        yield child
+                    else:
+                        frontier.append((level + 1, child))
+            while frontier:
+                yield frontier.popleft()[1]
+        finally:
+            self.finish_search()
+
+    def bt_recurse_split(self, propagator, var_ord, val_ord, depth, path):
+        '''Internal routine of bt_subproblems. path is the list of
+           (Variable, value) assignments made so far'''
+
+        if depth <= 0 or not self.unasgn_vars:
+            yield list(path)
+            return
+
+        if var_ord:
+            var = var_ord(self.csp)
+        else:
+            var = self.unasgn_vars[0]
+        self.unasgn_vars.remove(var)
+
+        if val_ord:
+            value_order = val_ord(self.csp,var)
+        else:
+            value_order = var.cur_domain()
+        if len(value_order) > 1:
+            depth = depth - 1
+
+        for val in value_order:
+            mark = self.trail.mark()
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+
+            status, prunings = propagator(self.csp, var)
+            self.nPrunings = self.nPrunings + self.trail.mark() - mark
+
+            if status:
+                path.append((var, val))
+                yield from self.bt_recurse_split(propagator, var_ord, val_ord, depth, path)
+                path.pop()
+
+            self.trail.undo(mark)
+            var.unassign()
+
+        self.restoreUnasgnVar(var)
+
+    def bt_search_restarts(self, propagator, var_ord=None, val_ord=None,
+                           restarts="luby", base=100, factor=1.5, seed=None):
+        '''Like bt_search, but the search is restarted each time it makes
+           more decisions than a cutoff, with ties in the variable and
+           value orderings broken at random (seeded with seed) so each run
+           explores a different part of the tree.
+
+           The cutoff of run i is base * luby(i) decisions if restarts is
+           "luby", base * factor**(i-1) if it is "geometric". The growing
+           cutoffs make the search complete.
+
+           When a run is cut off the values it refuted on its current
+           branch are recorded as nogoods (in self.nogoods, a NogoodStore)
+           and pruned by every later run, so no run searches a part of the
+           tree already refuted. Constraint weights (see ord_dom_wdeg)
+           also carry over between runs.'''
+
+        stime = time.process_time()
+        old_rng = self.csp.rng
+        self.csp.rng = random.Random(seed)
+        try:
+            self.nogoods = NogoodStore()
+            status = self.start_search(propagator)
+
+            run = 0
+            while status != False:
+                run = run + 1
+                if restarts == "geometric":
+                    cutoff = self.nDecisions + int(base * factor ** (run - 1))
+                else:
+                    cutoff = self.nDecisions + base * luby(run)
+                self.path = []
+                status = self.bt_recurse_restart(propagator, var_ord, val_ord, 1, cutoff)
+                if status != None:
+                    break
+                self.nRestarts = self.nRestarts + 1
+                #refuted values are pruned at the root for all later runs
+                mark = self.trail.mark()
+                status, n = self.nogoods.prune_units()
+                if status and n:
+                    status, prunings = propagator(self.csp)
+                self.nPrunings = self.nPrunings + self.trail.mark() - mark
+
+            self.finish_search()
+        finally:
+            #the caller's csp keeps its own orderings
+            self.csp.rng = old_rng
+        self.runtime = time.process_time() - stime
+        self.print_result(status, "bt_search_restarts")
+        if not self.QUIET:
+            print("Search restarted {} times and recorded {} nogoods".format(
+                self.nRestarts, len(self.nogoods)))
+        return status
+
+    def bt_recurse_restart(self, propagator, var_ord, val_ord, level, cutoff):
+        '''Return True if found solution, False if there is no solution
+           below this point, None if nDecisions reached cutoff first. In
+           that case the values refuted at each level on the way back up
+           are recorded as nogoods: the branching assignments in
+           self.path above the level plus the refuted assignment.'''
+
+        if not self.unasgn_vars:
+            return True
+
+        rng = self.csp.rng
+        if var_ord:
+            var = var_ord(self.csp)
+        else:
+            var = rng.choice(self.unasgn_vars)
+        self.unasgn_vars.remove(var)
+
+        if val_ord:
+            value_order = val_ord(self.csp,var)
+        else:
+            value_order = var.cur_domain()
+            rng.shuffle(value_order)
+        #forced assignments follow from the ones above, so are left out
+        #of the nogoods
+        branching = len(value_order) > 1
+
+        refuted = []
+        for val in value_order:
+            if self.nDecisions >= cutoff:
+                status = None
+            else:
+                mark = self.trail.mark()
+                var.assign(val)
+                self.nDecisions = self.nDecisions+1
+
+                status, prunings = propagator(self.csp, var)
+                if status:
+                    status = self.nogoods.propagate(var)
+                self.nPrunings = self.nPrunings + self.trail.mark() - mark
+
+                if status:
+                    if branching:
+                        self.path.append((var, val))
+                    status = self.bt_recurse_restart(propagator, var_ord, val_ord, level+1, cutoff)
+                    if status:
+                        return True
+                    if branching:
+                        self.path.pop()
+
+                self.trail.undo(mark)
+                var.unassign()
+
+            if status == None:
+                for v in refuted:
+                    self.nogoods.add(self.path + [(var, v)])
+                self.restoreUnasgnVar(var)
+                return None
+            refuted.append(val)
+
+        self.restoreUnasgnVar(var)
+        return False
+
+    def bt_search_cbj(self, propagator, var_ord=None, val_ord=None):
+        '''Like bt_search, but with conflict-directed backjumping: when
+           every value of a variable fails, search jumps back to the
+           deepest decision that contributed to the failures, skipping
+           the decisions in between, which would fail again the same way.
+
+           Each pruning is explained by a bitmask of the decision levels
+           responsible for it, kept on the trail (see Variable.expl). The
+           propagators explain the prunings they make with a constraint
+           by the constraint's other variables (Constraint.explanation)
+           and report failing constraints with wipe_out. Prunings made
+           without an explanation are blamed on every level, which is
+           always safe: search then backtracks chronologically.'''
+
+        stime = time.process_time()
+        status = self.start_search(propagator)
+        self.trail.explaining = True
+        if status != False:
+            status = self.bt_recurse_cbj(propagator, var_ord, val_ord, 1) is True
+        self.finish_search()
+        self.trail.explaining = False
+        self.runtime = time.process_time() - stime
+        self.print_result(status, "bt_search_cbj")
+        if not self.QUIET:
+            print("Search backjumped over {} levels".format(self.nBackjumps))
+        return status
+
+    def bt_recurse_cbj(self, propagator, var_ord, val_ord, level):
+        '''Return True if found solution. Otherwise return the conflict
+           set: the bitmask of the levels (below this one) whose decisions
+           explain why there is no solution below this point.'''
+
+        if not self.unasgn_vars:
+            return True
+
+        if var_ord:
+            var = var_ord(self.csp)
+        else:
+            var = self.unasgn_vars[0]
+        self.unasgn_vars.remove(var)
+
+        if val_ord:
+            value_order = val_ord(self.csp,var)
+        else:
+            value_order = var.cur_domain()
+        #values pruned before this level are explained by var.expl;
+        #a forced assignment is explained by the same levels
+        conflict = var.expl
+        var.asgn_expl = (1 << level) if len(value_order) > 1 else 0
+        below = (1 << level) - 1
+
+        for val in value_order:
+            mark = self.trail.mark()
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+
+            self.csp.last_conflict = None
+            status, prunings = propagator(self.csp, var)
+            self.nPrunings = self.nPrunings + self.trail.mark() - mark
+
+            if status:
+                expl = self.bt_recurse_cbj(propagator, var_ord, val_ord, level+1)
+                if expl is True:
+                    return True
+            elif self.csp.last_conflict is not None:
+                expl = self.csp.last_conflict.explanation()
+            else:
+                expl = -1
+
+            self.trail.undo(mark)
+            var.unassign()
+
+            if not expl & var.asgn_expl:
+                #this decision played no part: the other values fail too
+                self.nBackjumps = self.nBackjumps + 1
+                self.restoreUnasgnVar(var)
+                return expl & below
+            conflict |= expl
 
+        self.restoreUnasgnVar(var)
+        return conflict & below
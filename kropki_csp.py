@@ -6,11 +6,13 @@ Construct and return Kropki Grid CSP models.
 '''
 
 from cspbase import *
+from propagators import prop_GAC, ord_mrv
 import itertools
 
 class KropkiBoard:
     '''Abstract class for defining KropkiBoards for search routines'''
-    def __init__(self, dim, cell_values, consec_row, consec_col, double_row, double_col):
+    def __init__(self, dim, cell_values, consec_row, consec_col, double_row, double_col,
+                 box_height=None, box_width=None):
         '''Problem specific state space objects must always include the data items
            a) self.dim === the dimension of the board (rows, cols)
            b) self.cell_values === a list of lists. Each list holds values in a row on the grid. Values range from 1 to dim);
@@ -28,6 +30,9 @@ class KropkiBoard:
            hold two values, one of which is the twice the value of the other.  For example, if a list has a value of 1 in 
            position 0, this means the value in the column at index 0 myst be either twice or one half the value at index 1 in that
            column.
+           g) self.box_height, self.box_width === the number of rows and columns of each sub-square. 
+           If neither is given the default shape for dim is used (see default_box_shape). ValueError
+           is raised if the sub-squares do not tile the board.
         '''
         self.dim = dim
         self.cell_values = cell_values
@@ -35,9 +40,291 @@ class KropkiBoard:
         self.consec_col = consec_col        
         self.double_row = double_row
         self.double_col = double_col        
+        if box_height == None and box_width == None:
+            box_height, box_width = default_box_shape(dim)
+        else:
+            check_box_shape(dim, (box_height, box_width))
+        self.box_height = box_height
+        self.box_width = box_width
 
+    def box_shape(self):
+        '''return (rows, columns) of the board's sub-squares'''
+        return (self.box_height, self.box_width)
 
-def kropki_csp_model_1(initial_kropki_board):
+    def units(self):
+        '''return the units of the board (see kropki_units)'''
+        return kropki_units(self.dim, self.box_shape())
+
+
+def neq_relation(domain):
+    '''Shared table of the binary NOT-EQUAL relation over domain'''
+    return get_relation("neq", [domain, domain], lambda: 
+        [a for a in itertools.product(domain, domain) if a[0] != a[1]])
+
+class DotConstraint(Constraint):
+    '''Binary constraint between two adjacent cells given by a relation
+       on their values rather than a table of tuples. Supports are found
+       on value bitmasks (see Variable.value_mask): partners(mask) is the
+       mask of the values related to some value in mask, so the supported
+       values of one cell are its mask ANDed with the partners of the
+       other's. Subclasses define related and partners.'''
+
+    def add_satisfying_tuples(self, tuples):
+        '''Dot constraints are not specified by tuples'''
+        print("ERROR: trying to add satisfying tuples to dot constraint", self)
+
+    def related(self, a, b):
+        '''return True iff the values a and b satisfy the constraint'''
+        return False
+
+    def partners(self, mask):
+        return 0
+
+    def check(self, vals):
+        return self.related(vals[0], vals[1])
+
+    def has_support(self, var, val):
+        '''Test if var=val is related to a value in the current domain of
+           the other cell'''
+        if not var in self.scope or not var.in_cur_domain(val):
+            return False
+        other = self.scope[1] if var is self.scope[0] else self.scope[0]
+        return self.partners(1 << val) & other.value_mask() != 0
+
+    def unsupported_values(self):
+        '''Generate the (var, val) pairs, var an unassigned cell, such
+           that val has no partner in the other cell's current domain'''
+        x, y = self.scope
+        for var, other in ((x, y), (y, x)):
+            if not var.is_assigned():
+                unsup = var.value_mask() & ~self.partners(other.value_mask())
+                while unsup:
+                    low = unsup & -unsup
+                    yield var, low.bit_length() - 1
+                    unsup ^= low
+
+    def print_all(self):
+        print("{}({}):{}".format(self.name,[var.name for var in self.scope],
+                                 type(self).__name__))
+
+class ConsecutiveConstraint(DotConstraint):
+    '''White dot: the two values differ by one'''
+
+    def related(self, a, b):
+        return abs(a - b) == 1
+
+    def partners(self, mask):
+        return (mask << 1) | (mask >> 1)
+
+class DoubleConstraint(DotConstraint):
+    '''Black dot: one value is twice the other'''
+
+    partner_cache = dict()  #mask -> partners, shared by all instances
+
+    def related(self, a, b):
+        return a == 2*b or b == 2*a
+
+    def partners(self, mask):
+        p = DoubleConstraint.partner_cache.get(mask)
+        if p == None:
+            p, m = 0, mask
+            while m:
+                low = m & -m
+                v = low.bit_length() - 1
+                p |= 1 << (2*v)
+                if v % 2 == 0:
+                    p |= 1 << (v // 2)
+                m ^= low
+            DoubleConstraint.partner_cache[mask] = p
+        return p
+
+class NoDotConstraint(DotConstraint):
+    '''No dot (the negative Kropki rule): the two values neither differ
+       by one nor is one twice the other'''
+
+    partner_cache = dict()  #mask -> partners, shared by all instances
+
+    def related(self, a, b):
+        return abs(a - b) != 1 and a != 2*b and b != 2*a
+
+    def partners(self, mask):
+        p = NoDotConstraint.partner_cache.get(mask)
+        if p == None:
+            p, m = 0, mask
+            while m:
+                low = m & -m
+                v = low.bit_length() - 1
+                #every value but v-1, v+1, 2v and v/2 (a negative int
+                #has all the higher bits set)
+                banned = (low << 1) | (low >> 1) | (1 << (2*v))
+                if v % 2 == 0:
+                    banned |= 1 << (v // 2)
+                p |= ~banned
+                m ^= low
+            NoDotConstraint.partner_cache[mask] = p
+        return p
+
+def kropki_domain(dim):
+    '''The default domain of a cell of a dim x dim board: 1 to dim'''
+    return list(range(1, dim+1))
+
+def kropki_variables(initial_kropki_board):
+    '''Return the list of cell variables of the board, variable_array[i*N+j]
+       being cell i,j. Its domain is {1-N} if the board has a -1 there and {i}
+       (with the variable assigned) if the board has a number i there.'''
+    dim = initial_kropki_board.dim
+    domain_dft = kropki_domain(dim)
+    vars = []
+    # Naming convention: Q {ROW}{COLUMN}
+    for i in range(dim):
+        for j in range(dim):
+            dom_sel = domain_dft
+            if initial_kropki_board.cell_values[i][j] != -1:
+                dom_sel = [initial_kropki_board.cell_values[i][j]]
+            temp = BitVariable("Q{}{}".format(i, j), dom_sel)
+            if temp.domain_size() == 1:
+                temp.assign(temp.domain()[0])
+            vars.append(temp)
+    return vars
+
+def default_box_shape(dim):
+    '''Return the default (rows, columns) of the sub-squares of a dim x dim
+       board: 3 rows by 2 columns for 6x6, 3x3 for 9x9 and 3 rows by 4
+       columns for 12x12. For other dimensions the rows are the largest
+       divisor of dim no larger than its square root (4x4 for 16x16, 2x4 for
+       8x8). A dim that is prime (or less than 4) gives (1, dim): whole
+       rows, so the board has no sub-squares.'''
+    if dim == 6:
+        return (3, 2)
+    height = 1
+    for d in range(2, dim + 1):
+        if d * d > dim:
+            break
+        if dim % d == 0:
+            height = d
+    return (height, dim // height)
+
+def check_box_shape(dim, box):
+    '''Raise ValueError unless box is a (rows, columns) pair of positive
+       ints whose sub-squares tile a dim x dim board'''
+    if (len(box) != 2 or not all(isinstance(n, int) and n > 0 for n in box)
+            or box[0] * box[1] != dim):
+        raise ValueError("sub-squares of {} do not tile a board of dimension {}".format(box, dim))
+
+def subsquares(dim, box=None):
+    '''Return the sub-squares of a dim x dim board, each a list of
+       (row, column) cells. box is the (rows, columns) of each sub-square,
+       default_box_shape(dim) if it is None (ValueError is raised if it does
+       not tile the board). Sub-squares that are whole rows or columns add
+       nothing, so none are returned for them.'''
+    if box == None:
+        box = default_box_shape(dim)
+    check_box_shape(dim, box)
+    height, width = box
+    if height == 1 or width == 1:
+        return []
+    squares = []
+    for y in range(dim // height):
+        for x in range(dim // width):
+            squares.append([(y*height+qy, x*width+qx) 
+                            for qy in range(height) for qx in range(width)])
+    return squares
+
+def kropki_units(dim, box=None):
+    '''Return the units of a dim x dim board with sub-squares of box
+       (rows, columns), each a (name, cells) pair with cells a list of
+       (row, column) cells: the rows, then the columns, then the
+       sub-squares'''
+    units = []
+    for i in range(dim):
+        units.append(("Row{}".format(i+1), [(i, j) for j in range(dim)]))
+    for i in range(dim):
+        units.append(("Col{}".format(i+1), [(j, i) for j in range(dim)]))
+    for k, square in enumerate(subsquares(dim, box)):
+        units.append(("SS{}".format(k+1), square))
+    return units
+
+def model_1_neq_constraints(dim, vars, box=None):
+    '''Return the binary NOT-EQUAL constraints of model_1 between every
+       pair of cells in the same row, column or sub-square (of box
+       rows by columns, see subsquares)'''
+    domain_dft = kropki_domain(dim)
+    cons = []
+    for name, unit in kropki_units(dim, box):
+        for qi in range(len(unit)):
+            for qj in range(qi+1, len(unit)):
+                (r1, c1), (r2, c2) = unit[qi], unit[qj]
+                c = Constraint("C(Q{}{}, Q{}{})".format(r1+1, c1+1, r2+1, c2+1), 
+                               [vars[r1*dim+c1], vars[r2*dim+c2]])
+                c.set_relation(neq_relation(domain_dft))
+                cons.append(c)
+    return cons
+
+def model_2_neq_constraints(dim, vars, box=None):
+    '''Return the N-ary NOT-EQUAL (all-different) constraints of model_2,
+       one for each row, column and sub-square (of box rows by columns)'''
+    return [AllDiffConstraint(name, [vars[r*dim+c] for (r, c) in unit])
+            for name, unit in kropki_units(dim, box)]
+
+def add_kropki_units(csp, dim, vars, neq_cons, box=None):
+    '''Declare the rows, columns and sub-squares (of box rows by columns)
+       of the board as units of
+       csp (see CSP.add_unit, used by prop_UNITS), each implying the
+       NOT-EQUAL constraints in neq_cons over its cells. An all-different
+       constraint over the whole unit is used as the unit itself.'''
+    units = []
+    unit_of = dict()    #variable -> indices of the units it is in
+    for k, (name, cells) in enumerate(kropki_units(dim, box)):
+        scope = [vars[r*dim+c] for (r, c) in cells]
+        units.append((name, scope, []))
+        for v in scope:
+            unit_of.setdefault(v, set()).add(k)
+    for c in neq_cons:
+        for k in set.intersection(*(unit_of[v] for v in c.scope)):
+            units[k][2].append(c)
+    for name, scope, implied in units:
+        unit = None
+        for c in implied:
+            if len(c.scope) == len(scope):
+                unit = c
+        if unit == None:
+            unit = AllDiffConstraint(name, scope)
+        csp.add_unit(unit, implied)
+
+def dot_constraints(initial_kropki_board, vars, no_dot=False):
+    '''Return the binary consecutive and double constraints for the dots
+       of the board, rows first, then columns. If no_dot is True also
+       return a NoDotConstraint for each pair of adjacent cells without a
+       dot (the negative rule)'''
+    board = initial_kropki_board
+    dim = board.dim
+    cons = []
+    for i in range(dim):
+        for j in range(len(board.consec_row[i])):
+            cons.extend(pair_constraints(board.consec_row[i][j], board.double_row[i][j], no_dot,
+                                         "C(Q{}{}, Q{}{})".format(i+1, j+1, i+1, j+2),
+                                         [vars[i*dim+j], vars[i*dim+j+1]]))
+    # consec_col[i][j] is between rows j and j+1 of column i
+    for i in range(dim):
+        for j in range(len(board.consec_col[i])):
+            cons.extend(pair_constraints(board.consec_col[i][j], board.double_col[i][j], no_dot,
+                                         "C(Q{}{}, Q{}{})".format(j+1, i+1, j+2, i+1),
+                                         [vars[j*dim+i], vars[(j+1)*dim+i]]))
+    return cons
+
+def pair_constraints(consec, double, no_dot, name, scope):
+    '''Internal routine. Return the list of dot constraints for a pair of
+       adjacent cells with the given consecutive and double dot flags'''
+    cons = []
+    if consec == 1:
+        cons.append(ConsecutiveConstraint(name, scope))
+    if double == 1:
+        cons.append(DoubleConstraint(name, scope))
+    if no_dot and not cons:
+        cons.append(NoDotConstraint(name, scope))
+    return cons
+
+def kropki_csp_model_1(initial_kropki_board, no_dot=False):
     '''Return a tuple containing a CSP object representing a Kropki Grid CSP problem along 
        with an array of variables for the problem. That is, return
 
@@ -60,168 +347,36 @@ def kropki_csp_model_1(initial_kropki_board):
        same row, etc.).
 
        model_1 also contains binary consecutive and double constraints for each 
-       column and row, as well as sub-square constraints.
+       column and row, as well as sub-square constraints. The dot constraints
+       are ConsecutiveConstraints and DoubleConstraints, filtered on value
+       bitmasks. If no_dot is True every pair of adjacent cells without a
+       dot gets a NoDotConstraint (the negative rule, which not every
+       puzzle follows).
+
+       The rows, columns and sub-squares are also declared as units of the
+       CSP (see add_kropki_units), for unit inference with prop_UNITS.
 
        Note that we will only test on boards of size 6x6, 9x9 and 12x12
        Subsquares on boards of dimension 6x6 are each 2x3.
        Subsquares on boards of dimension 9x9 are each 3x3.
        Subsquares on boards of dimension 12x12 are each 4x3.
+       Other dimensions and sub-square shapes are taken from the board
+       (see KropkiBoard.box_shape).
     '''
-    #IMPLEMENT
-    domain_dft = []
-    
-    cons = []
-   
-    vars = []
     dim = initial_kropki_board.dim
-    
-    #The default domain
-    for i in range(dim):
-       domain_dft.append(i+1)
-       
-    # Initiating the Variables
-    # Naming convention: Q {ROW}{COLUMN}
-    for i in range(dim):
-       for j in range(dim):
-          dom_sel = domain_dft
-          if initial_kropki_board.cell_values[i][j] != -1:
-             dom_sel = [initial_kropki_board.cell_values[i][j]]
-          temp = Variable("Q{}{}".format(i, j), dom_sel)
-          if temp.domain_size() == 1:
-             temp.assign(temp.domain()[0])   
-          vars.append(temp)
-   
-    # Initiating the horizontial constrains
-    for i in range(dim):
-       # Row NON-EQUAL
-       for qi in range (dim):
-          for qj in range (qi+1, dim):
-             c = Constraint("C(Q{}{}, Q{}{})".format(i+1, qi+1, i+1, qj+1), [vars[i*dim+qi], vars[i*dim+qj]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if a[0] != a[1]:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-             
-       # Row consecutive
-       cur = initial_kropki_board.consec_row[i]
-       for rc_i in range(len(cur)):
-          if cur[rc_i] == 1:
-             c = Constraint("C(Q{}{}, Q{}{})".format(i+1, rc_i+1, i+1, rc_i+2), [vars[i*dim+rc_i], vars[i*dim+rc_i+1]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if abs(a[0]-a[1]) == 1:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-       
-       # Row double
-       cur = initial_kropki_board.double_row[i]
-       for rc_i in range(len(cur)):
-          if cur[rc_i] == 1:
-             c = Constraint("C(Q{}{}, Q{}{})".format(i+1, rc_i+1, i+1, rc_i+2), [vars[i*dim+rc_i], vars[i*dim+rc_i+1]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if a[0]*2 == a[1] or a[1]*2 == a[0]:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-    
-    # Initiating the vertical constrains
-    for i in range(dim):
-       # Column NON-EQUAL
-       for qi in range(dim):
-          for qj in range (qi+1, dim):
-             c = Constraint("C(Q{}{}, Q{}{})".format(qi+1, i+1, qj+1, i+1), [vars[i+qi*dim], vars[i+qj*dim]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if a[0] != a[1]:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-             
-       # Column consecutive
-       cur = initial_kropki_board.consec_col[i]
-       for rc_i in range(len(cur)):
-          if cur[rc_i] == 1:
-             c = Constraint("C(Q{}{}, Q{}{})".format(rc_i+1, i+1, rc_i+2, i+1), [vars[i+rc_i*dim], vars[i+(rc_i+1)*dim]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if abs(a[0]-a[1]) == 1:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-       
-       # Column double
-       cur = initial_kropki_board.double_col[i]
-       for rc_i in range(len(cur)):
-          if cur[rc_i] == 1:
-             c = Constraint("C(Q{}{}, Q{}{})".format(rc_i+1, i+1, rc_i+2, i+1), [vars[i+rc_i*dim], vars[i+(rc_i+1)*dim]])
-             tups = []
-             for a in itertools.product(domain_dft, domain_dft):
-                if a[0]*2 == a[1] or a[1]*2 == a[0]:
-                   tups.append(a)
-             c.add_satisfying_tuples(tups)
-             cons.append(c)
-    
-    # Subsqure NON-EQUAL only for 6x6 and 9x9
-    if dim == 6:
-       # divide 6x6 into 6 3x2
-       for y in range(2):
-          for x in range(3):
-             
-             # iterating over the 6 squares of the inner square
-             # Get coordinates in the sub squares
-             coord_list = []
-             for qy in range(3):
-                for qx in range(2):
-                   coord_list.append((y*3+qy, x*2+qx))
-                   
-             # Iterating over the 6 coords to check they are not equal
-             for i in range(6):
-                for j in range(i+1, 6):
-                   c = Constraint("C(Q{}{}, Q{}{})".format(coord_list[i][0]+1, coord_list[i][1]+1, coord_list[j][0]+1, coord_list[j][1]+1), [vars[coord_list[i][0]*6+coord_list[i][1]], vars[coord_list[j][0]*6+coord_list[j][1]]])
-                   tups = []
-                   for a in itertools.product(domain_dft, domain_dft):
-                      if a[0] != a[1]:
-                         tups.append(a)
-                c.add_satisfying_tuples(tups)
-                cons.append(c)           
-    elif dim == 9:
-       # divide 6x6 into 9 3x3
-       for y in range(3):
-          for x in range(3):
-             
-             # iterating over the 6 squares of the inner square
-             # Get coordinates in the sub squares
-             coord_list = []
-             for qy in range(3):
-                for qx in range(3):
-                   coord_list.append((y*3+qy, x*2+qx))
-                   
-             # Iterating over the 6 coords to check they are not equal
-             for i in range(9):
-                for j in range(i+1, 9):
-                   c = Constraint("C(Q{}{}, Q{}{})".format(coord_list[i][0]+1, coord_list[i][1]+1, coord_list[j][0]+1, coord_list[j][1]+1), [vars[coord_list[i][0]*6+coord_list[i][1]], vars[coord_list[j][0]*6+coord_list[j][1]]])
-                   tups = []
-                   for a in itertools.product(domain_dft, domain_dft):
-                      if a[0] != a[1]:
-                         tups.append(a)
-                c.add_satisfying_tuples(tups)
-                cons.append(c) 
-    else:
-       print("Invalid dimention provided") 
-       
+    vars = kropki_variables(initial_kropki_board)
+    box = initial_kropki_board.box_shape()
+    neq_cons = model_1_neq_constraints(dim, vars, box)
+    cons = neq_cons + dot_constraints(initial_kropki_board, vars, no_dot)
+
     game = CSP("{}x{} Kropki".format(dim, dim), vars)
-    
     for c in cons:
-       game.add_constraint(c)
-   
-    return game, vars #change this!
+        game.add_constraint(c)
+    add_kropki_units(game, dim, vars, neq_cons, box)
+    return game, vars
 
-def kropki_csp_model_2(initial_kropki_board):
-   '''Return a tuple containing a CSP object representing a Kropki Grid CSP problem along 
+def kropki_csp_model_2(initial_kropki_board, no_dot=False):
+    '''Return a tuple containing a CSP object representing a Kropki Grid CSP problem along 
        with an array of variables for the problem. That is return
 
        kropki_csp, variable_array
@@ -240,155 +395,191 @@ def kropki_csp_model_2(initial_kropki_board):
        
        model_2 contains N-ARY CONSTRAINTS OF NOT-EQUAL between
        all relevant variables (e.g., all variables in the
-       same row, etc.).
+       same row, etc.). These are AllDiffConstraints, so no table of
+       permutations is built and GAC on them uses bipartite matching.
 
        model_2 also contains binary consecutive and double constraints for each 
-       column and row, as well as sub-square constraints.
+       column and row, as well as sub-square constraints. The dot constraints
+       are ConsecutiveConstraints and DoubleConstraints, filtered on value
+       bitmasks. If no_dot is True every pair of adjacent cells without a
+       dot gets a NoDotConstraint (the negative rule, which not every
+       puzzle follows).
+
+       The rows, columns and sub-squares are also declared as units of the
+       CSP (see add_kropki_units), for unit inference with prop_UNITS.
 
        Note that we will only test on boards of size 6x6, 9x9 and 12x12
        Subsquares on boards of dimension 6x6 are each 2x3.
        Subsquares on boards of dimension 9x9 are each 3x3.
        Subsquares on boards of dimension 12x12 are each 4x3.
+       Other dimensions and sub-square shapes are taken from the board
+       (see KropkiBoard.box_shape).
     '''
-   #IMPLEMENT
-   domain_dft = []
-    
-   cons = []
-   
-   vars = []
-   dim = initial_kropki_board.dim
-    
-   #The default domain
-   for i in range(dim):
-      domain_dft.append(i+1)
-       
-   # Initiating the Variables
-   # Naming convention: Q {ROW}{COLUMN}
-   for i in range(dim):
-      for j in range(dim):
-         dom_sel = domain_dft
-         if initial_kropki_board.cell_values[i][j] != -1:
-            dom_sel = [initial_kropki_board.cell_values[i][j]]
-         temp = Variable("Q{}{}".format(i, j), dom_sel)
-         if temp.domain_size() == 1:
-            temp.assign(temp.domain()[0])
-         vars.append(temp)
-   
-   # For the NON-EQUAL, the constrains are the same thus
-   neq_cons = []
-   for i in itertools.permutations(domain_dft, dim):
-      neq_cons.append(i)
-   
-   # Initiating the horizontial constrains
-   for i in range(dim):
-      
-      # Row NON-EQUAL
-      l_var = []
-      for qi in range (dim):
-         l_var.append(vars[i*dim+qi])
-            
-      c = Constraint("Row{}".format(qi+1), l_var)
-      c.add_satisfying_tuples(neq_cons)
-      cons.append(c)
-            
-      # Row consecutive
-      cur = initial_kropki_board.consec_row[i]
-      for rc_i in range(len(cur)):
-         if cur[rc_i] == 1:
-            c = Constraint("C(Q{}{}, Q{}{})".format(i+1, rc_i+1, i+1, rc_i+2), [vars[i*dim+rc_i], vars[i*dim+rc_i+1]])
-            tups = []
-            for a in itertools.product(domain_dft, domain_dft):
-               if abs(a[0]-a[1]) == 1:
-                  tups.append(a)
-            c.add_satisfying_tuples(tups)
-            cons.append(c)
-      
-      # Row double
-      cur = initial_kropki_board.double_row[i]
-      for rc_i in range(len(cur)):
-         if cur[rc_i] == 1:
-            c = Constraint("C(Q{}{}, Q{}{})".format(i+1, rc_i+1, i+1, rc_i+2), [vars[i*dim+rc_i], vars[i*dim+rc_i+1]])
-            tups = []
-            for a in itertools.product(domain_dft, domain_dft):
-               if a[0]*2 == a[1] or a[1]*2 == a[0]:
-                  tups.append(a)
-            c.add_satisfying_tuples(tups)
-            cons.append(c)
-    
-    # Initiating the vertical constrains
-   for i in range(dim):
-   
-      # Column NON-EQUAL
-      l_var = []
-      for qi in range (dim):
-         l_var.append(vars[dim*qi+i])
-            
-      c = Constraint("Col{}".format(i+1), l_var)
-      c.add_satisfying_tuples(neq_cons)
-      cons.append(c)
-             
-      # Column consecutive
-      cur = initial_kropki_board.consec_col[i]
-      for rc_i in range(len(cur)):
-         if cur[rc_i] == 1:
-            c = Constraint("C(Q{}{}, Q{}{})".format(rc_i+1, i+1, rc_i+2, i+1), [vars[i+rc_i*dim], vars[i+(rc_i+1)*dim]])
-            tups = []
-            for a in itertools.product(domain_dft, domain_dft):
-               if abs(a[0]-a[1]) == 1:
-                  tups.append(a)
-            c.add_satisfying_tuples(tups)
-            cons.append(c)
-       
-      # Column double
-      cur = initial_kropki_board.double_col[i]
-      for rc_i in range(len(cur)):
-         if cur[rc_i] == 1:
-            c = Constraint("C(Q{}{}, Q{}{})".format(rc_i+1, i+1, rc_i+2, i+1), [vars[i+rc_i*dim], vars[i+(rc_i+1)*dim]])
-            tups = []
-            for a in itertools.product(domain_dft, domain_dft):
-               if a[0]*2 == a[1] or a[1]*2 == a[0]:
-                  tups.append(a)
-            c.add_satisfying_tuples(tups)
-            cons.append(c)
-    
-   # Subsqure NON-EQUAL only for 6x6 and 9x9
-   if dim == 6:
-      # divide 6x6 into 6 3x2
-      for y in range(2):
-         for x in range(3):
-            # iterating over the 6 squares of the inner square
-            subsq_list = [] 
-            for i in range(3):
-               for j in range(2):
-                  subsq_list.append(vars[(y*3+i)*6+(x*2+j)])
-            
-            # Constraint
-            c = Constraint("SS{}{}".format(y+1, x+1), subsq_list)     
-            c.add_satisfying_tuples(neq_cons)
-            cons.append(c)
-   elif dim == 9:
-      # divide 9x9 into 9 3x3
-      for y in range(3):
-         for x in range(3):
-            # iterating over the 6 squares of the inner square
-            subsq_list = [] 
-            for i in range(3):
-               for j in range(3):
-                  subsq_list.append(vars[(y*3+i)*9+(x*3+j)])
-            
-            # Constraint
-            c = Constraint("SS{}{}".format(y+1, x+1), subsq_list)     
-            c.add_satisfying_tuples(neq_cons)
-            cons.append(c)
-   else:
-      print("Invalid dimention provided")
-      
-   game = CSP("{}x{} Kropki".format(dim, dim), vars)
-    
-   for c in cons:
-      game.add_constraint(c)
-   
-   return game, vars #change this!
-
-
-    
+    dim = initial_kropki_board.dim
+    vars = kropki_variables(initial_kropki_board)
+    box = initial_kropki_board.box_shape()
+    neq_cons = model_2_neq_constraints(dim, vars, box)
+    cons = neq_cons + dot_constraints(initial_kropki_board, vars, no_dot)
+
+    game = CSP("{}x{} Kropki".format(dim, dim), vars)
+    for c in cons:
+        game.add_constraint(c)
+    add_kropki_units(game, dim, vars, neq_cons, box)
+    return game, vars
+
+
+class KropkiTemplate:
+    '''A Kropki model (model_1 or model_2) compiled once for a board
+       dimension: the cell variables (with full domains) and the
+       NOT-EQUAL constraints, which are the same for every board of that
+       dimension. instantiate sets up the template for a particular board
+       by giving the variables the board's cell values and attaching the
+       board's dot constraints, which is much cheaper than building the
+       model from scratch. box is the (rows, columns) of the sub-squares,
+       default_box_shape(dim) if it is None; a template only instantiates
+       boards with the same dimension and sub-squares.
+
+       The variables and constraints are reused, so instantiating the
+       template again invalidates the CSP returned for the previous board
+       (use kropki_csp_model_1/2 for models that must coexist).'''
+
+    def __init__(self, dim, model=1, no_dot=False, box=None):
+        self.dim = dim
+        self.box = tuple(box) if box != None else default_box_shape(dim)
+        self.model = model
+        self.no_dot = no_dot
+        self.domain = kropki_domain(dim)
+        self.vars = []
+        for i in range(dim):
+            for j in range(dim):
+                self.vars.append(BitVariable("Q{}{}".format(i, j), self.domain))
+        if model == 1:
+            self.base_cons = model_1_neq_constraints(dim, self.vars, self.box)
+        else:
+            self.base_cons = model_2_neq_constraints(dim, self.vars, self.box)
+        self.csp = CSP("{}x{} Kropki".format(dim, dim), self.vars)
+        for c in self.base_cons:
+            self.csp.add_constraint(c)
+        add_kropki_units(self.csp, dim, self.vars, self.base_cons, self.box)
+        self.dot_cons = []
+
+    def instantiate(self, initial_kropki_board):
+        '''Return (kropki_csp, variable_array) for the board, as
+           kropki_csp_model_1/2 do'''
+        board = initial_kropki_board
+        dim = self.dim
+        if board.dim != dim:
+            print("ERROR: board of dimension", board.dim, "for template of dimension", dim)
+            return None, None
+        if board.box_shape() != self.box:
+            print("ERROR: board with sub-squares", board.box_shape(), "for template with sub-squares", self.box)
+            return None, None
+
+        #rebuilt lazily by ord_mrv once the new constraints are in
+        self.csp.detach_size_index()
+        self.csp.remove_constraints(self.dot_cons)
+        for i in range(dim):
+            for j in range(dim):
+                var = self.vars[i*dim+j]
+                val = board.cell_values[i][j]
+                if val == -1:
+                    var.reset_domain(self.domain)
+                else:
+                    var.reset_domain([val])
+                    var.assign(val)
+        for c in self.base_cons:
+            c.clear_caches()
+
+        self.dot_cons = dot_constraints(board, self.vars, self.no_dot)
+        for c in self.dot_cons:
+            self.csp.add_constraint(c)
+        return self.csp, list(self.vars)
+
+#Compiled templates, see kropki_template
+templates = dict()
+
+def kropki_template(dim, model=1, no_dot=False, box=None):
+    '''return the KropkiTemplate for boards of dimension dim with
+       sub-squares of box (rows, columns), model 1 or 2 and the no_dot rule,
+       compiling it the first time it is asked for'''
+    box = tuple(box) if box != None else default_box_shape(dim)
+    template = templates.get((dim, box, model, no_dot))
+    if template == None:
+        template = KropkiTemplate(dim, model, no_dot, box)
+        templates[(dim, box, model, no_dot)] = template
+    return template
+
+def kropki_csp_compiled(initial_kropki_board, model=1, no_dot=False):
+    '''Return (kropki_csp, variable_array) for the board using model 1
+       or 2, like kropki_csp_model_1/2, but instantiated from the compiled
+       template for the board's dimension and sub-squares (see
+       KropkiTemplate)'''
+    board = initial_kropki_board
+    return kropki_template(board.dim, model, no_dot, board.box_shape()).instantiate(board)
+
+
+class KropkiResult:
+    '''The result of solving a KropkiBoard (see solve_kropki):
+       a) self.solution === the solved grid as a list of lists (like
+          KropkiBoard.cell_values), or None if the board has no solution.
+       b) self.nDecisions, self.nPrunings === the search statistics of BT.
+       c) self.runtime === the CPU time used by the search.
+       d) self.index === the position of the board in a batch (see
+          kropki_parallel.solve_kropki_batch), None otherwise.'''
+
+    def __init__(self, solution, nDecisions, nPrunings, runtime, index=None):
+        self.solution = solution
+        self.nDecisions = nDecisions
+        self.nPrunings = nPrunings
+        self.runtime = runtime
+        self.index = index
+
+    def __repr__(self):
+        return "KropkiResult({}, solved={}, nDecisions={}, nPrunings={}, runtime={:.4f})".format(
+            self.index, self.solution != None, self.nDecisions, self.nPrunings, self.runtime)
+
+def kropki_csp_model(initial_kropki_board, model=1, compiled=False, no_dot=False):
+    '''Internal routine. Return (kropki_csp, variable_array) for the board
+       using model 1 or 2, from the compiled template if compiled is True'''
+    if compiled:
+        return kropki_csp_compiled(initial_kropki_board, model, no_dot)
+    elif model == 1:
+        return kropki_csp_model_1(initial_kropki_board, no_dot)
+    else:
+        return kropki_csp_model_2(initial_kropki_board, no_dot)
+
+def solve_kropki(initial_kropki_board, model=1, propagator=prop_GAC, var_ord=ord_mrv, compiled=False,
+                 no_dot=False, preprocess=None):
+    '''Solve the board with bt_search, without printing, using model 1 or
+       2 (from the compiled template if compiled is True, with the negative
+       rule if no_dot is True, running preprocess at the root if it is not
+       None, see BT.preprocess) and return a KropkiResult'''
+    dim = initial_kropki_board.dim
+    csp, var_array = kropki_csp_model(initial_kropki_board, model, compiled, no_dot)
+    solver = BT(csp)
+    solver.quiet_on()
+    solver.preprocess = preprocess
+    solution = None
+    if solver.bt_search(propagator, var_ord=var_ord):
+        solution = [[var_array[i*dim+j].get_assigned_value() for j in range(dim)] 
+                    for i in range(dim)]
+    return KropkiResult(solution, solver.nDecisions, solver.nPrunings, solver.runtime)
+
+def kropki_solutions(initial_kropki_board, model=1, propagator=prop_GAC, var_ord=ord_mrv,
+                     limit=None, compiled=False, no_dot=False):
+    '''Generate the solved grids (lists of lists) of the board, at most
+       limit of them if limit is not None, from a single search
+       (see BT.bt_solutions)'''
+    dim = initial_kropki_board.dim
+    csp, var_array = kropki_csp_model(initial_kropki_board, model, compiled, no_dot)
+    solver = BT(csp)
+    for soln in solver.bt_solutions(propagator, var_ord=var_ord, limit=limit):
+        yield [[soln[var_array[i*dim+j]] for j in range(dim)] for i in range(dim)]
+
+def count_kropki_solutions(initial_kropki_board, limit=2, model=1, propagator=prop_GAC,
+                           var_ord=ord_mrv, compiled=False, no_dot=False):
+    '''Return the number of solutions of the board, counting no further
+       than limit (None for no limit). With the default limit of 2 the
+       board has a unique solution iff the result is 1.'''
+    csp, var_array = kropki_csp_model(initial_kropki_board, model, compiled, no_dot)
+    return BT(csp).count_solutions(propagator, var_ord=var_ord, limit=limit)
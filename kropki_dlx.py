@@ -0,0 +1,297 @@
+'''
+Solve and count the solutions of Kropki boards with Algorithm X on
+dancing links (DLX).
+
+Without its dots a Kropki board is an exact cover problem: each row of
+the cover matrix places a value v in a cell, and covers the columns
+"the cell is filled" and "v is in row r", "v is in column c" and "v is
+in sub-square s" for the units of the cell (see kropki_csp.kropki_units).
+A solution is a set of rows covering every column exactly once.
+
+The dots are enforced in two ways:
+
+    before search    rows are pruned by arc consistency on the cell
+                     candidates: givens remove their value from the other
+                     cells of their units, and each side of a dot keeps
+                     only the values related to a candidate of the other
+                     side.
+
+    during search    a row is only chosen if its value is related to the
+                     values already placed in the cells across its dots
+                     (a side check).
+
+The matrix is stored in flat lists of links (L, R, U, D) indexed by
+node, with node 0 the root and nodes 1 to ncols the column headers, and
+the search is iterative, so solutions can be generated and counted
+without recursion.
+'''
+
+import time
+
+from kropki_csp import KropkiResult
+
+class KropkiDLX:
+    '''The DLX cover matrix of a KropkiBoard. If no_dot is True the
+       negative rule is enforced between adjacent cells without a dot.
+
+       self.nDecisions and self.runtime are the statistics of the last
+       search, and self.nPrunings is the number of rows pruned before
+       search.'''
+
+    def __init__(self, initial_kropki_board, no_dot=False):
+        board = initial_kropki_board
+        self.dim = dim = board.dim
+        units = [cells for name, cells in board.units()]
+        self.unit_of = [[] for k in range(dim*dim)]
+        for u, cells in enumerate(units):
+            for (i, j) in cells:
+                self.unit_of[i*dim+j].append(u)
+        self.dots = self.dot_relations(board, no_dot)
+        cand = self.candidates(board, units)
+
+        # columns: cell k is column 1+k, value v in unit u is column
+        # 1+dim*dim+u*dim+(v-1)
+        ncols = dim*dim + len(units)*dim
+        self.L = list(range(-1, ncols))
+        self.L[0] = ncols
+        self.R = list(range(1, ncols+1)) + [0]
+        self.U = list(range(ncols+1))
+        self.D = list(range(ncols+1))
+        self.C = list(range(ncols+1))
+        self.S = [0] * (ncols+1)
+        self.row_of = [None] * (ncols+1)   #node -> (cell, value) of its row
+        for k in range(dim*dim):
+            for v in sorted(cand[k]):
+                cols = [1+k] + [1+dim*dim+u*dim+(v-1) for u in self.unit_of[k]]
+                self.add_row((k, v), cols)
+        self.ncols = ncols
+        self.nPrunings = dim*dim*dim - sum(len(c) for c in cand)
+        self.nDecisions = 0
+        self.runtime = 0
+
+    def dot_relations(self, board, no_dot):
+        '''Internal routine. return for each cell the list of (neighbour,
+           related) pairs of its dots, with related[a][b] True iff the
+           value a in the cell and b in the neighbour satisfy every dot
+           between them'''
+        dim = board.dim
+        values = range(dim+1)
+        consec = [[abs(a - b) == 1 for b in values] for a in values]
+        double = [[a == 2*b or b == 2*a for b in values] for a in values]
+        none = [[not consec[a][b] and not double[a][b] for b in values] for a in values]
+        dots = [[] for k in range(dim*dim)]
+        pairs = []
+        for i in range(dim):
+            for j in range(dim-1):
+                pairs.append((i*dim+j, i*dim+j+1, board.consec_row[i][j], board.double_row[i][j]))
+                # consec_col[i][j] is between rows j and j+1 of column i
+                pairs.append((j*dim+i, (j+1)*dim+i, board.consec_col[i][j], board.double_col[i][j]))
+        for a, b, is_consec, is_double in pairs:
+            if is_consec == 1 and is_double == 1:
+                related = [[consec[x][y] and double[x][y] for y in values] for x in values]
+            elif is_consec == 1:
+                related = consec
+            elif is_double == 1:
+                related = double
+            elif no_dot:
+                related = none
+            else:
+                continue
+            dots[a].append((b, related))
+            dots[b].append((a, related))
+        return dots
+
+    def candidates(self, board, units):
+        '''Internal routine. return the candidate values (sets) of each
+           cell, pruned by the givens and the dots until nothing changes'''
+        dim = self.dim
+        cand = []
+        for i in range(dim):
+            for j in range(dim):
+                val = board.cell_values[i][j]
+                cand.append({val} if val != -1 else set(range(1, dim+1)))
+        peers = [set() for k in range(dim*dim)]
+        for cells in units:
+            ks = [i*dim+j for (i, j) in cells]
+            for k in ks:
+                peers[k].update(ks)
+        changed = True
+        while changed:
+            changed = False
+            for k in range(dim*dim):
+                if len(cand[k]) == 1:
+                    v = next(iter(cand[k]))
+                    for p in peers[k]:
+                        if p != k and v in cand[p]:
+                            cand[p].discard(v)
+                            changed = True
+                for n, related in self.dots[k]:
+                    supported = {a for a in cand[k] if any(related[a][b] for b in cand[n])}
+                    if len(supported) < len(cand[k]):
+                        cand[k] = supported
+                        changed = True
+        return cand
+
+    def add_row(self, row, cols):
+        '''Internal routine. Append a row covering the columns cols'''
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        first = len(C)
+        for n, c in enumerate(cols):
+            node = first + n
+            L.append(node - 1 if n > 0 else first + len(cols) - 1)
+            R.append(node + 1 if n < len(cols) - 1 else first)
+            U.append(U[c])
+            D.append(c)
+            D[U[c]] = node
+            U[c] = node
+            C.append(c)
+            S[c] = S[c] + 1
+            self.row_of.append(row)
+
+    def cover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        R[L[c]] = R[c]
+        L[R[c]] = L[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                D[U[j]] = D[j]
+                U[D[j]] = U[j]
+                S[C[j]] = S[C[j]] - 1
+                j = R[j]
+            i = D[i]
+
+    def uncover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                S[C[j]] = S[C[j]] + 1
+                D[U[j]] = j
+                U[D[j]] = j
+                j = L[j]
+            i = U[i]
+        R[L[c]] = c
+        L[R[c]] = c
+
+    def choose_column(self):
+        '''Internal routine. return the uncovered column with the fewest
+           rows'''
+        R, S = self.R, self.S
+        best, size = 0, None
+        c = R[0]
+        while c != 0:
+            if size == None or S[c] < size:
+                best, size = c, S[c]
+                if size <= 1:
+                    break
+            c = R[c]
+        return best
+
+    def consistent(self, row, value):
+        '''Internal routine. Side check: return True iff the value of row
+           satisfies the dots with the cells already filled'''
+        k, v = row
+        for n, related in self.dots[k]:
+            w = value[n]
+            if w and not related[v][w]:
+                return False
+        return True
+
+    def solutions(self, limit=None):
+        '''Generate the solved grids (lists of lists) of the board, at
+           most limit of them if limit is not None'''
+        dim, ncols = self.dim, self.ncols
+        R, D, C = self.R, self.D, self.C
+        self.nDecisions = 0
+        stime = time.process_time()
+        found = 0
+        value = [0] * (dim*dim)     #value placed in each cell, 0 if none
+        stack = []                  #the row node chosen at each level
+        try:
+            if R[0] == 0:
+                return
+            c = self.choose_column()
+            self.cover(c)
+            r = D[c]
+            while True:
+                if r <= ncols:
+                    #every row of column c has been tried
+                    self.uncover(c)
+                    if not stack:
+                        return
+                    r = self.undo_row(stack.pop(), value)
+                    c = C[r]
+                    r = D[r]
+                    continue
+                row = self.row_of[r]
+                if not self.consistent(row, value):
+                    r = D[r]
+                    continue
+                self.nDecisions = self.nDecisions + 1
+                value[row[0]] = row[1]
+                j = R[r]
+                while j != r:
+                    self.cover(C[j])
+                    j = R[j]
+                stack.append(r)
+                if R[0] == 0:
+                    found = found + 1
+                    yield [value[i*dim:(i+1)*dim] for i in range(dim)]
+                    if limit != None and found >= limit:
+                        return
+                    r = self.undo_row(stack.pop(), value)
+                    c = C[r]
+                    r = D[r]
+                    continue
+                c = self.choose_column()
+                self.cover(c)
+                r = D[c]
+        finally:
+            #leave the matrix as it was built
+            while stack:
+                r = self.undo_row(stack.pop(), value)
+                self.uncover(C[r])
+            self.runtime = time.process_time() - stime
+
+    def undo_row(self, r, value):
+        '''Internal routine. Uncover the other columns of the row of node r
+           and empty its cell; return r'''
+        L, C = self.L, self.C
+        j = L[r]
+        while j != r:
+            self.uncover(C[j])
+            j = L[j]
+        value[self.row_of[r][0]] = 0
+        return r
+
+    def count(self, limit=None):
+        '''return the number of solutions of the board, counting no
+           further than limit if limit is not None'''
+        n = 0
+        for soln in self.solutions(limit):
+            n = n + 1
+        return n
+
+    def solve(self):
+        '''Search for a solution and return a KropkiResult'''
+        solution = next(self.solutions(limit=1), None)
+        return KropkiResult(solution, self.nDecisions, self.nPrunings, self.runtime)
+
+def solve_kropki_dlx(initial_kropki_board, no_dot=False):
+    '''Solve the board with DLX (with the negative rule if no_dot is True)
+       and return a KropkiResult'''
+    return KropkiDLX(initial_kropki_board, no_dot).solve()
+
+def kropki_solutions_dlx(initial_kropki_board, limit=None, no_dot=False):
+    '''Generate the solved grids of the board, at most limit of them if
+       limit is not None, with DLX'''
+    return KropkiDLX(initial_kropki_board, no_dot).solutions(limit)
+
+def count_kropki_solutions_dlx(initial_kropki_board, limit=2, no_dot=False):
+    '''Return the number of solutions of the board with DLX, counting no
+       further than limit (None for no limit). With the default limit of 2
+       the board has a unique solution iff the result is 1.'''
+    return KropkiDLX(initial_kropki_board, no_dot).count(limit)
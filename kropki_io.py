@@ -0,0 +1,189 @@
+'''
+Read and write Kropki boards and solutions as JSON lines, and solve a
+stream of boards from the command line.
+
+Each board is one line holding a JSON object with the KropkiBoard data
+items (see kropki_csp):
+
+    {"dim":6,"cells":[[1,6,5,4,-1,3],...],"consec_row":[[0,1,1,0,1],...],
+     "consec_col":[...],"double_row":[...],"double_col":[...],"box":[3,2]}
+
+"box" is the (rows, columns) of the sub-squares; if it is missing the
+default shape for the dimension is used (see kropki_csp.default_box_shape).
+
+Each solution is one line holding a JSON object with the KropkiResult
+data items ("solution" is null if the board has no solution):
+
+    {"index":0,"solution":[[1,6,5,4,2,3],...],"nDecisions":36,
+     "nPrunings":30,"runtime":0.01}
+
+A board line that cannot be decoded gets an error line in its place,
+and the rest of the stream is still solved:
+
+    {"index":3,"solution":null,"error":"ValueError: sub-squares of (2, 4)
+     do not tile a board of dimension 7"}
+
+Blank lines and lines starting with # are ignored when reading. The
+readers and writers work on one line at a time, so streams of any
+length can be processed in bounded memory.
+
+Usage:
+    python kropki_io.py [boards.jsonl] [-o solutions.jsonl] [--model 2]
+                        [--propagator FC] [--var-ord dom_wdeg] [--processes 4]
+
+reads boards from the file (or standard input) and writes one solution
+line for each, in the same order, to the output file (or standard
+output). The output can be cut short (e.g. piped into head); the
+command then stops quietly.
+'''
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+
+from kropki_csp import KropkiBoard
+from propagators import prop_BT, prop_FC, prop_GAC, prop_UNITS, ord_mrv, ord_dom_wdeg
+
+PROPAGATORS = {"BT": prop_BT, "FC": prop_FC, "GAC": prop_GAC, "UNITS": prop_UNITS}
+VAR_ORDS = {"none": None, "mrv": ord_mrv, "dom_wdeg": ord_dom_wdeg}
+
+def board_to_json(board):
+    '''return the one line JSON encoding of a KropkiBoard'''
+    return json.dumps({"dim": board.dim,
+                       "cells": board.cell_values,
+                       "consec_row": board.consec_row,
+                       "consec_col": board.consec_col,
+                       "double_row": board.double_row,
+                       "double_col": board.double_col,
+                       "box": list(board.box_shape())},
+                      separators=(',', ':'))
+
+def board_from_json(line):
+    '''return the KropkiBoard encoded by a line (see board_to_json)'''
+    d = json.loads(line)
+    box_height, box_width = d.get("box") or (None, None)
+    return KropkiBoard(d["dim"], d["cells"], d["consec_row"], d["consec_col"],
+                       d["double_row"], d["double_col"], box_height, box_width)
+
+def result_to_json(result):
+    '''return the one line JSON encoding of a KropkiResult'''
+    return json.dumps({"index": result.index,
+                       "solution": result.solution,
+                       "nDecisions": result.nDecisions,
+                       "nPrunings": result.nPrunings,
+                       "runtime": round(result.runtime, 6)},
+                      separators=(',', ':'))
+
+def error_to_json(index, message):
+    '''return the one line JSON encoding of the error for the board at
+       position index'''
+    return json.dumps({"index": index, "solution": None, "error": message},
+                      separators=(',', ':'))
+
+def read_lines(stream):
+    '''Internal routine. Generate the stripped non blank, non comment lines'''
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def read_boards(stream):
+    '''Generate the KropkiBoards of a stream of JSON lines'''
+    for line in read_lines(stream):
+        yield board_from_json(line)
+
+def read_board_records(stream):
+    '''Generate (board, error) for each board line of a stream of JSON
+       lines: board is its KropkiBoard and error None, or board is None
+       and error describes why the line could not be decoded'''
+    for line in read_lines(stream):
+        try:
+            yield board_from_json(line), None
+        except (ValueError, KeyError, TypeError) as e:
+            yield None, "{}: {}".format(type(e).__name__, e)
+
+def read_solutions(stream):
+    '''Generate the decoded solution objects (dicts) of a stream of JSON lines'''
+    for line in read_lines(stream):
+        yield json.loads(line)
+
+def write_boards(stream, boards):
+    '''Write each KropkiBoard of boards to stream as a JSON line'''
+    for board in boards:
+        stream.write(board_to_json(board))
+        stream.write('\n')
+
+def write_results(stream, results):
+    '''Write each KropkiResult of results to stream as a JSON line, as
+       soon as it is generated'''
+    for result in results:
+        stream.write(result_to_json(result))
+        stream.write('\n')
+        stream.flush()
+
+def main(argv=None):
+    # imported here so that the readers and writers do not need
+    # the multiprocessing machinery
+    from kropki_parallel import solve_kropki_batch
+
+    parser = argparse.ArgumentParser(description="Solve a stream of Kropki boards (JSON lines)")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="file of boards, - for standard input (default)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="file for the solutions, - for standard output (default)")
+    parser.add_argument("--model", type=int, choices=[1, 2], default=1)
+    parser.add_argument("--propagator", choices=sorted(PROPAGATORS), default="GAC")
+    parser.add_argument("--var-ord", choices=sorted(VAR_ORDS), default="mrv")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+    #one entry per board line read: its error line, or its index if it
+    #was handed to the solver. The solver reads ahead of its results, so
+    #the error lines before each result are at the front when it arrives.
+    lines = deque()
+
+    def boards():
+        for index, (board, error) in enumerate(read_board_records(infile)):
+            if board == None:
+                lines.append(error_to_json(index, error))
+            else:
+                lines.append(index)
+                yield board
+
+    def write_errors():
+        while lines and not isinstance(lines[0], int):
+            outfile.write(lines.popleft())
+            outfile.write('\n')
+
+    results = solve_kropki_batch(boards(), model=args.model,
+                                 propagator=PROPAGATORS[args.propagator],
+                                 var_ord=VAR_ORDS[args.var_ord],
+                                 processes=args.processes)
+    try:
+        for result in results:
+            write_errors()
+            result.index = lines.popleft()
+            write_results(outfile, [result])
+        write_errors()
+        outfile.flush()
+    except BrokenPipeError:
+        #the reader has gone: stop solving, and send anything still
+        #buffered to devnull so that exiting does not raise again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, outfile.fileno())
+        return 1
+    finally:
+        results.close()
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+'''
+Solve Kropki boards on a NumPy candidate tensor instead of CSP Variables.
+
+A board is represented as a dim x dim x dim boolean array cand, with
+cand[i, j, k] True iff the value k+1 is still a candidate for the cell
+in row i, column j. Propagation works on the whole tensor at once:
+
+    all-different    naked singles are removed from the other cells of
+                     their row, column and sub-square, and a value with a
+                     single place left in a unit is placed there (hidden
+                     singles). Both are reductions along an axis of the
+                     tensor (the sub-squares are a reshaped view of it).
+
+    dots             the candidates of each cell are ANDed with the values
+                     supported by its neighbour across a dot: the
+                     neighbour's candidates shifted by one value for
+                     consecutive dots, and moved by the index maps k -> 2k+1
+                     and 2k+1 -> k for double dots. With the negative rule
+                     (no_dot) pairs without a dot are filtered by a boolean
+                     matrix product with the NO-DOT relation.
+
+These passes are repeated until nothing changes, so a board is
+propagated in a handful of array operations rather than one Python call
+per variable and value as prop_FC and prop_GAC do. KropkiTensor searches
+depth first on copies of the tensor, branching on a cell with the fewest
+candidates.
+
+The same operations work on a leading batch axis: KropkiTensorBatch
+stacks many boards of one size into a (batch, dim, dim, dim) array and
+propagates them all together, and solve_kropki_tensor_batch searches
+with BT only the boards that propagation leaves unsolved.
+
+This module needs NumPy; the rest of the solver does not.
+'''
+
+import time
+
+import numpy as np
+
+from kropki_csp import KropkiBoard, KropkiResult, solve_kropki
+from propagators import prop_GAC, ord_mrv
+
+class KropkiTensor:
+    '''The candidate tensor engine for a KropkiBoard (see the module
+       docstring). If no_dot is True the negative rule is enforced
+       between adjacent cells without a dot.
+
+       Like BT, self.nDecisions, self.nPrunings and self.runtime are the
+       statistics of the last search.'''
+
+    def __init__(self, initial_kropki_board, no_dot=False):
+        board = initial_kropki_board
+        self.dim = dim = board.dim
+        self.box = board.box_shape()
+        self.no_dot = no_dot
+
+        self.cand = np.ones((dim, dim, dim), dtype=bool)
+        for i in range(dim):
+            for j in range(dim):
+                val = board.cell_values[i][j]
+                if val != -1:
+                    self.cand[i, j, :] = False
+                    if 1 <= val <= dim:
+                        self.cand[i, j, val-1] = True
+
+        # row dots are between columns j and j+1 of row i, and the column
+        # dots (consec_col[i][j], between rows j and j+1 of column i) are
+        # transposed to be between rows i and i+1 of column j
+        self.consec_row = np.array(board.consec_row, dtype=bool).reshape(dim, dim-1)
+        self.double_row = np.array(board.double_row, dtype=bool).reshape(dim, dim-1)
+        self.consec_col = np.array(board.consec_col, dtype=bool).reshape(dim, dim-1).T
+        self.double_col = np.array(board.double_col, dtype=bool).reshape(dim, dim-1).T
+        if no_dot:
+            self.no_dot_row = ~(self.consec_row | self.double_row)
+            self.no_dot_col = ~(self.consec_col | self.double_col)
+            values = np.arange(1, dim+1)
+            a, b = values[:, None], values[None, :]
+            self.no_dot_relation = (np.abs(a - b) != 1) & (a != 2*b) & (b != 2*a)
+
+        # value k+1 doubled is value 2k+2, at index 2k+1
+        self.half = np.arange((dim // 2))
+        self.twice = 2 * self.half + 1
+
+        self.nDecisions = 0
+        self.nPrunings = 0
+        self.runtime = 0
+
+    def consecutive_support(self, cand):
+        '''return the values with a consecutive value among the candidates
+           of each cell'''
+        support = np.zeros_like(cand)
+        support[..., 1:] |= cand[..., :-1]
+        support[..., :-1] |= cand[..., 1:]
+        return support
+
+    def double_support(self, cand):
+        '''return the values with their double or half among the
+           candidates of each cell'''
+        support = np.zeros_like(cand)
+        support[..., self.twice] |= cand[..., self.half]
+        support[..., self.half] |= cand[..., self.twice]
+        return support
+
+    def no_dot_support(self, cand):
+        '''return the values with a NO-DOT partner among the candidates of
+           each cell'''
+        return np.matmul(cand, self.no_dot_relation)
+
+    def dot_filters(self):
+        '''return the (support, row_mask, col_mask) triples used by
+           filter_dots: the masks are True for the pairs of adjacent cells
+           that are NOT filtered by support, and have a trailing axis to
+           broadcast over the values'''
+        filters = [(self.consecutive_support, self.consec_row, self.consec_col),
+                   (self.double_support, self.double_row, self.double_col)]
+        if self.no_dot:
+            filters.append((self.no_dot_support, self.no_dot_row, self.no_dot_col))
+        return [(support, ~row_mask[..., None], ~col_mask[..., None])
+                for support, row_mask, col_mask in filters]
+
+    def filter_dots(self, cand, filters):
+        '''Filter the candidates of the cells on either side of each dot
+           by the values supported by the other side (see dot_filters)'''
+        for support, row_mask, col_mask in filters:
+            cand[..., :, :-1, :] &= support(cand[..., :, 1:, :]) | row_mask
+            cand[..., :, 1:, :] &= support(cand[..., :, :-1, :]) | row_mask
+            cand[..., :-1, :, :] &= support(cand[..., 1:, :, :]) | col_mask
+            cand[..., 1:, :, :] &= support(cand[..., :-1, :, :]) | col_mask
+
+    def box_view(self, cand):
+        '''return cand reshaped to (box row, row in box, box column,
+           column in box, value), or None if the board has no sub-squares'''
+        height, width = self.box
+        if height == 1 or width == 1 or height * width != self.dim:
+            return None
+        dim = self.dim
+        return cand.reshape(cand.shape[:-3] + (dim // height, height, dim // width, width, dim))
+
+    def any_per_board(self, a, cand):
+        '''Internal routine. return a (whose leading axes are the board
+           axes of cand) reduced by any() to one value per board'''
+        return a.reshape(cand.shape[:-3] + (-1,)).any(axis=-1)
+
+    def filter_units(self, cand):
+        '''Remove the naked singles of each row, column and sub-square from
+           the other cells of the unit and place its hidden singles.
+           Return whether each board is still consistent: False if a unit
+           has two equal singles, a value with no place left or a cell with
+           two hidden singles. Candidates of a cell may be wiped out.'''
+        single = cand & (cand.sum(axis=-1) == 1)[..., None]
+        placed = [single.sum(axis=-2), single.sum(axis=-3)]
+        single_box = self.box_view(single)
+        if single_box is not None:
+            placed.append(single_box.sum(axis=(-4, -2)))
+        ok = np.ones(cand.shape[:-3], dtype=bool)
+        for n in placed:
+            ok &= ~self.any_per_board(n > 1, cand)
+
+        keep = ~(single.any(axis=-2)[..., :, None, :] | single.any(axis=-3)[..., None, :, :])
+        if single_box is not None:
+            in_box = single_box.any(axis=(-4, -2))[..., :, None, :, None, :]
+            keep &= ~np.broadcast_to(in_box, single_box.shape).reshape(cand.shape)
+        cand &= keep | single
+
+        places = [cand.sum(axis=-2), cand.sum(axis=-3)]
+        cand_box = self.box_view(cand)
+        if cand_box is not None:
+            places.append(cand_box.sum(axis=(-4, -2)))
+        for n in places:
+            ok &= ~self.any_per_board(n == 0, cand)
+        hidden = cand & ((places[0] == 1)[..., :, None, :] | (places[1] == 1)[..., None, :, :])
+        if cand_box is not None:
+            in_box = (places[2] == 1)[..., :, None, :, None, :]
+            hidden |= cand & np.broadcast_to(in_box, cand_box.shape).reshape(cand.shape)
+        ok &= ~self.any_per_board(hidden.sum(axis=-1) > 1, cand)
+        forced = hidden.any(axis=-1)
+        cand[forced] = hidden[forced]
+        return ok
+
+    def propagate(self, cand):
+        '''Propagate the units and dots on cand (in place) until nothing
+           changes. Return False if a cell or a unit is wiped out.'''
+        filters = self.dot_filters()
+        size = cand.sum()
+        while True:
+            self.filter_dots(cand, filters)
+            if not self.filter_units(cand) or not cand.any(axis=-1).all():
+                return False
+            new_size = cand.sum()
+            if new_size == size:
+                return True
+            self.nPrunings = self.nPrunings + int(size - new_size)
+            size = new_size
+
+    def solutions(self, limit=None):
+        '''Generate the solved grids (lists of lists) of the board, at
+           most limit of them if limit is not None'''
+        self.nDecisions = 0
+        self.nPrunings = 0
+        stime = time.process_time()
+        found = 0
+        stack = [(self.cand.copy(), False)]
+        try:
+            while stack:
+                cand, decision = stack.pop()
+                if decision:
+                    self.nDecisions = self.nDecisions + 1
+                if not self.propagate(cand):
+                    continue
+                count = cand.sum(axis=-1)
+                if (count == 1).all():
+                    found = found + 1
+                    yield (cand.argmax(axis=-1) + 1).tolist()
+                    if limit != None and found >= limit:
+                        return
+                    continue
+                # branch on the first cell with the fewest candidates,
+                # smallest value first
+                cell = np.unravel_index(np.where(count > 1, count, self.dim + 1).argmin(), count.shape)
+                for k in np.flatnonzero(cand[cell])[::-1]:
+                    child = cand.copy()
+                    child[cell] = False
+                    child[cell + (k,)] = True
+                    stack.append((child, True))
+        finally:
+            self.runtime = time.process_time() - stime
+
+    def solve(self):
+        '''Search for a solution and return a KropkiResult'''
+        solution = next(self.solutions(limit=1), None)
+        return KropkiResult(solution, self.nDecisions, self.nPrunings, self.runtime)
+
+def solve_kropki_tensor(initial_kropki_board, no_dot=False):
+    '''Solve the board with the candidate tensor engine (with the negative
+       rule if no_dot is True) and return a KropkiResult'''
+    return KropkiTensor(initial_kropki_board, no_dot).solve()
+
+
+class KropkiTensorBatch(KropkiTensor):
+    '''The candidate tensors of several boards, all of the same dimension
+       and sub-squares, stacked along a leading batch axis into a
+       (batch, dim, dim, dim) array (self.cand) and propagated together
+       by propagate_all. The dot masks are stacked the same way.'''
+
+    def __init__(self, boards, no_dot=False):
+        tensors = [KropkiTensor(board, no_dot) for board in boards]
+        first = tensors[0]
+        self.dim = first.dim
+        self.box = first.box
+        self.no_dot = no_dot
+        self.cand = np.stack([t.cand for t in tensors])
+        self.consec_row = np.stack([t.consec_row for t in tensors])
+        self.double_row = np.stack([t.double_row for t in tensors])
+        self.consec_col = np.stack([t.consec_col for t in tensors])
+        self.double_col = np.stack([t.double_col for t in tensors])
+        if no_dot:
+            self.no_dot_row = ~(self.consec_row | self.double_row)
+            self.no_dot_col = ~(self.consec_col | self.double_col)
+            self.no_dot_relation = first.no_dot_relation
+        self.half = first.half
+        self.twice = first.twice
+        self.nDecisions = 0
+        self.nPrunings = np.zeros(len(tensors), dtype=int)
+        self.runtime = 0
+
+    def propagate_all(self):
+        '''Propagate every board to its fixpoint, in place. Each pass works
+           on the boards still changing only. Return an array holding for
+           each board False if it was found to have no solution. Afterwards
+           self.nPrunings[b] is the number of values pruned from board b.'''
+        stime = time.process_time()
+        filters = self.dot_filters()
+        size = self.cand.sum(axis=(1, 2, 3))
+        start_size = size.copy()
+        ok = np.ones(len(self.cand), dtype=bool)
+        active = np.arange(len(self.cand))
+        while active.size:
+            cand = self.cand[active]
+            self.filter_dots(cand, [(support, row_mask[active], col_mask[active])
+                                    for support, row_mask, col_mask in filters])
+            good = self.filter_units(cand) & cand.any(axis=-1).all(axis=(-2, -1))
+            self.cand[active] = cand
+            new_size = cand.sum(axis=(1, 2, 3))
+            ok[active[~good]] = False
+            changed = good & (new_size != size[active])
+            size[active] = new_size
+            active = active[changed]
+        self.nPrunings = start_size - size
+        self.runtime = time.process_time() - stime
+        return ok
+
+    def solved(self):
+        '''return an array holding for each board True iff every cell has
+           a single candidate'''
+        return (self.cand.sum(axis=-1) == 1).all(axis=(-2, -1))
+
+    def grid(self, b):
+        '''return the grid (list of lists) of board b, with -1 for the
+           cells with several candidates'''
+        cand = self.cand[b]
+        return np.where(cand.sum(axis=-1) == 1, cand.argmax(axis=-1) + 1, -1).tolist()
+
+def solve_kropki_tensor_batch(boards, model=1, propagator=prop_GAC, var_ord=ord_mrv,
+                              no_dot=False, batch_size=1024):
+    '''Solve each KropkiBoard of the iterable boards, generating a
+       KropkiResult for each, in the order of the boards (result.index is
+       the position of the board in boards).
+
+       Runs of consecutive boards of the same dimension and sub-squares
+       are propagated together, at most batch_size at a time, on a
+       KropkiTensorBatch. Boards solved (or refuted) by propagation alone
+       need no search; each of the others is searched with solve_kropki
+       (model 1 or 2, propagator, var_ord, compiled template) on a copy
+       of the board with the singles found by propagation as givens.
+
+       The runtime of a result is its share of the batch propagation plus
+       its own search, and nPrunings adds up both.'''
+    batch = []
+    for index, board in enumerate(boards):
+        if batch and (len(batch) >= batch_size or board.dim != batch[0][1].dim
+                      or board.box_shape() != batch[0][1].box_shape()):
+            for result in tensor_batch_results(batch, model, propagator, var_ord, no_dot):
+                yield result
+            batch = []
+        batch.append((index, board))
+    if batch:
+        for result in tensor_batch_results(batch, model, propagator, var_ord, no_dot):
+            yield result
+
+def tensor_batch_results(batch, model, propagator, var_ord, no_dot):
+    '''Internal routine. Generate the KropkiResults of a list of
+       (index, board) pairs (see solve_kropki_tensor_batch)'''
+    tensors = KropkiTensorBatch([board for index, board in batch], no_dot)
+    ok = tensors.propagate_all()
+    solved = tensors.solved()
+    share = tensors.runtime / len(batch)
+    for b, (index, board) in enumerate(batch):
+        nPrunings = int(tensors.nPrunings[b])
+        if not ok[b]:
+            result = KropkiResult(None, 0, nPrunings, share)
+        elif solved[b]:
+            result = KropkiResult(tensors.grid(b), 0, nPrunings, share)
+        else:
+            reduced = KropkiBoard(board.dim, tensors.grid(b), board.consec_row, board.consec_col,
+                                  board.double_row, board.double_col,
+                                  board.box_height, board.box_width)
+            result = solve_kropki(reduced, model, propagator, var_ord, compiled=True, no_dot=no_dot)
+            result.nPrunings = result.nPrunings + nPrunings
+            result.runtime = result.runtime + share
+        result.index = index
+        yield result
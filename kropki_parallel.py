@@ -0,0 +1,293 @@
+'''
+Solve Kropki boards using several processes.
+
+solve_kropki_batch fans a stream of boards out over a process pool and
+generates a KropkiResult (see kropki_csp) for each of them.
+
+solve_kropki_split and count_kropki_solutions_split work on a single
+hard board: its search tree is split at shallow depth (see
+BT.bt_subproblems) into subproblems that are searched by a pool of
+processes.
+
+KropkiPortfolio races several (model, propagator, var_ord) configurations
+on the same board, one long-lived process each, and keeps the first
+answer.
+'''
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import closing
+
+from cspbase import BT
+from kropki_csp import (KropkiBoard, KropkiResult, solve_kropki, kropki_csp_model,
+                        count_kropki_solutions)
+from propagators import prop_FC, prop_GAC, ord_mrv, ord_dom_wdeg
+
+def solve_task(task):
+    '''Worker routine. task is (index, board, model, propagator, var_ord);
+       return the board's KropkiResult. Each worker process reuses its own
+       compiled templates, so only the first board of each size pays for
+       building the model.'''
+    index, board, model, propagator, var_ord = task
+    result = solve_kropki(board, model, propagator, var_ord, compiled=True)
+    result.index = index
+    return result
+
+def solve_kropki_batch(boards, model=1, propagator=prop_GAC, var_ord=ord_mrv,
+                       processes=None, ordered=True, max_pending=None):
+    '''Solve each KropkiBoard of the iterable boards with model 1 or 2,
+       propagator and var_ord, generating a KropkiResult for each.
+
+       processes is the number of worker processes (default: one per CPU);
+       with 1 the boards are solved in this process. If ordered is True
+       the results are generated in the order of the boards, otherwise in
+       the order they complete (result.index is the position of the board
+       in boards). At most max_pending boards (default: 4 per process) are
+       handed to the pool at any time, so boards is consumed lazily and
+       memory stays bounded however many boards there are.'''
+    processes = processes or os.cpu_count() or 1
+    tasks = ((i, board, model, propagator, var_ord) for i, board in enumerate(boards))
+    if processes == 1:
+        for task in tasks:
+            yield solve_task(task)
+        return
+
+    max_pending = max_pending or 4 * processes
+    pool = ProcessPoolExecutor(processes)
+    try:
+        if ordered:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(solve_task, task))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            for task in tasks:
+                pending.add(pool.submit(solve_task, task))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+    finally:
+        #if the caller stops early do not solve the boards still queued
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def count_task(task):
+    '''Worker routine. task is (board, model, propagator, var_ord, limit);
+       return the number of solutions of the board, up to limit'''
+    board, model, propagator, var_ord, limit = task
+    return count_kropki_solutions(board, limit, model, propagator, var_ord, compiled=True)
+
+def portfolio_worker(conn, model, propagator, var_ord):
+    '''Worker routine. Solve each board received on conn with one
+       configuration and send back its KropkiResult, until None is
+       received'''
+    while True:
+        board = conn.recv()
+        if board == None:
+            return
+        conn.send(solve_kropki(board, model, propagator, var_ord, compiled=True))
+
+def kropki_subproblems(board, model=1, propagator=prop_GAC, var_ord=ord_mrv, depth=None,
+                       min_tasks=1, max_depth=6):
+    '''Split the search tree of the board into subproblems (see
+       BT.bt_subproblems) and return (boards, solver): boards generates
+       the subproblems, each as a copy of the board with the assignments
+       leading to it as extra givens, and solver is the BT object used.
+       The subproblems are generated lazily; once boards is exhausted
+       the statistics of solver count all the work of splitting, and if
+       boards is closed early they count only the splitting done so far.
+
+       If depth is not None the tree is split at its top depth branching
+       levels. Otherwise it is split breadth first (see BT.bt_frontier)
+       until there are at least min_tasks subproblems or the frontier is
+       max_depth levels deep.'''
+    dim = board.dim
+    csp, var_array = kropki_csp_model(board, model)
+    cell = {var: (k // dim, k % dim) for k, var in enumerate(var_array)}
+    solver = BT(csp)
+
+    def to_board(path):
+        cells = [list(row) for row in board.cell_values]
+        for var, val in path:
+            i, j = cell[var]
+            cells[i][j] = val
+        return KropkiBoard(dim, cells, board.consec_row, board.consec_col,
+                           board.double_row, board.double_col,
+                           board.box_height, board.box_width)
+
+    if depth != None:
+        paths = solver.bt_subproblems(propagator, var_ord, depth=depth)
+    else:
+        paths = solver.bt_frontier(propagator, var_ord, min_nodes=min_tasks, max_depth=max_depth)
+    return (to_board(path) for path in paths), solver
+
+def pool_results(worker, tasks, processes):
+    '''Internal routine. Generate worker(task) for each task, in the order
+       they complete, using processes worker processes (in this process if
+       processes is 1). Idle workers take the next task as soon as they
+       finish one, so long subproblems do not hold up the others. When
+       the generator is closed the workers are killed, abandoning the
+       tasks they are running.'''
+    if processes == 1:
+        for task in tasks:
+            yield worker(task)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(worker, tasks, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def solve_kropki_split(board, model=1, propagator=prop_GAC, var_ord=ord_mrv,
+                       processes=None, depth=None):
+    '''Solve the board by splitting its search tree into subproblems
+       (see kropki_subproblems, by default at least 8 per process) and
+       searching them with processes worker processes (default: one per
+       CPU). The subproblems are all built in this process before any is
+       handed out, so the workers never wait on the split. As soon as one
+       subproblem is solved the others are abandoned.
+
+       Return a KropkiResult; its nDecisions and nPrunings add up the
+       splitting and the subproblems searched to completion (so they are
+       partial if a solution is found early), and its runtime is the
+       elapsed (wall clock) time.'''
+    stime = time.perf_counter()
+    processes = processes or os.cpu_count() or 1
+    boards, splitter = kropki_subproblems(board, model, propagator, var_ord, depth,
+                                          min_tasks=8*processes)
+    with closing(boards):
+        tasks = [(i, b, model, propagator, var_ord) for i, b in enumerate(boards)]
+    nDecisions, nPrunings = splitter.nDecisions, splitter.nPrunings
+    solution = None
+    with closing(pool_results(solve_task, tasks, processes)) as results:
+        for result in results:
+            nDecisions = nDecisions + result.nDecisions
+            nPrunings = nPrunings + result.nPrunings
+            if result.solution != None:
+                solution = result.solution
+                break
+    return KropkiResult(solution, nDecisions, nPrunings, time.perf_counter() - stime)
+
+def count_kropki_solutions_split(board, limit=None, model=1, propagator=prop_GAC,
+                                 var_ord=ord_mrv, processes=None, depth=None):
+    '''Return the number of solutions of the board, counting no further
+       than limit if limit is not None, by counting the solutions of its
+       subproblems (see solve_kropki_split) in parallel and adding them up'''
+    processes = processes or os.cpu_count() or 1
+    boards, splitter = kropki_subproblems(board, model, propagator, var_ord, depth,
+                                          min_tasks=8*processes)
+    with closing(boards):
+        tasks = [(b, model, propagator, var_ord, limit) for b in boards]
+    total = 0
+    with closing(pool_results(count_task, tasks, processes)) as counts:
+        for count in counts:
+            total = total + count
+            if limit != None and total >= limit:
+                return limit
+    return total
+
+class KropkiPortfolio:
+    '''Solve boards by running several configurations, each a
+       (model, propagator, var_ord) triple as taken by solve_kropki,
+       concurrently in separate processes. The first configuration to
+       answer (with a solution or a proof there is none) wins.
+
+       Each configuration has one worker process that is kept from board
+       to board, along with its compiled templates. The losers are still
+       searching when the winner answers; they are killed and replaced
+       by fresh processes (which must compile their templates again),
+       unless they have finished by then too. Call close() (or use the
+       portfolio in a with statement) to stop the workers.
+
+       self.wins[k] counts the boards won by configuration k, and
+       self.winner is the configuration that won the last board.'''
+
+    default_configs = [(1, prop_GAC, ord_mrv),
+                       (2, prop_FC, ord_mrv),
+                       (1, prop_GAC, ord_dom_wdeg)]
+
+    def __init__(self, configs=None):
+        self.configs = list(configs or KropkiPortfolio.default_configs)
+        self.wins = [0] * len(self.configs)
+        self.nBoards = 0
+        self.winner = None
+        self.workers = [None] * len(self.configs)   #(process, connection) of each configuration
+
+    def start_worker(self, k):
+        '''Internal routine. Start the worker process of configuration k'''
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=portfolio_worker,
+                                          args=(child_conn,) + tuple(self.configs[k]),
+                                          daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[k] = (process, conn)
+
+    def kill_worker(self, k):
+        '''Internal routine. Kill the worker process of configuration k'''
+        process, conn = self.workers[k]
+        process.terminate()
+        process.join()
+        conn.close()
+        self.workers[k] = None
+
+    def solve(self, board):
+        '''Race the configurations on the board and return the winner's
+           KropkiResult (its runtime is the CPU time of the winning
+           search)'''
+        for k in range(len(self.configs)):
+            if self.workers[k] == None:
+                self.start_worker(k)
+            self.workers[k][1].send(board)
+        conns = [conn for process, conn in self.workers]
+        ready = multiprocessing.connection.wait(conns)
+        self.winner = min(conns.index(conn) for conn in ready)
+        result = conns[self.winner].recv()
+        for k, conn in enumerate(conns):
+            if k == self.winner:
+                continue
+            if conn.poll():
+                #finished as well: its answer is dropped but it is kept
+                conn.recv()
+            else:
+                self.kill_worker(k)
+                self.start_worker(k)
+        self.wins[self.winner] = self.wins[self.winner] + 1
+        self.nBoards = self.nBoards + 1
+        return result
+
+    def close(self):
+        '''Stop the worker processes'''
+        for k, worker in enumerate(self.workers):
+            if worker != None:
+                process, conn = worker
+                conn.send(None)
+                process.join()
+                conn.close()
+                self.workers[k] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def print_stats(self):
+        print("Portfolio solved {} boards".format(self.nBoards))
+        for (model, propagator, var_ord), wins in zip(self.configs, self.wins):
+            print("  model {} {} {}: won {} boards".format(
+                model, propagator.__name__, var_ord.__name__ if var_ord else "None", wins))
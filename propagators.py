@@ -35,6 +35,30 @@ propagator == a function with the following template
     NOTE propagator SHOULD NOT prune a value that has already been
     pruned! Nor should it prune a value twice.
 
+    When the csp has a trail attached (csp.trail, see cspbase.Trail, as
+    done by bt_search) every pruning is recorded on the trail and the
+    propagators below return an empty list instead, so that no list is
+    built at every search node. Called on a csp without a trail they
+    return the list of prunings as described above.
+
+    When a propagator returns False it reports the constraint that
+    failed by calling wipe_out, which bumps the constraint's weight (used
+    by ord_dom_wdeg) and records it as csp.last_conflict. A unit that is
+    not one of the CSP's constraints passes its bump on to the
+    constraints it implies (see wipe_out_unit).
+
+    prop_SAC is much stronger and costlier than prop_GAC; it is meant to
+    be run once before search, as BT.preprocess.
+
+    prop_UNITS replaces GAC on the all-different groups of variables the
+    CSP declares as units (see CSP.add_unit, e.g., the rows, columns and
+    boxes of a grid puzzle) by the inference rules human solvers use.
+
+    Propagators pass the constraint responsible for each pruning to
+    prune, so that backjumping search (BT.bt_search_cbj) can explain the
+    pruning by the decisions that reduced the constraint's other
+    variables.
+
     IF PROPAGATOR is called with newly_instantiated_variable = None
         PROCESSING REQUIRED:
             for plain backtracking (where we only check fully instantiated
@@ -59,6 +83,42 @@ propagator == a function with the following template
             for gac we initialize the GAC queue with all constraints containing
             V.
 '''
+import itertools
+import time
+from collections import deque
+
+def prune(csp, var, val, bookKeeping, c=None):
+    '''Prune val from var's current domain, adding the pruning to
+       bookKeeping unless the csp's trail is recording it. c is the
+       constraint that pruned the value; if the trail is explaining
+       prunings (see BT.bt_search_cbj) it supplies the explanation'''
+    if csp.trail is not None and csp.trail.explaining and c is not None:
+        csp.trail.reason = c.explanation(var)
+        var.prune_value(val)
+        csp.trail.reason = -1
+    else:
+        var.prune_value(val)
+    if csp.trail is None:
+        bookKeeping.append((var, val))
+
+def wipe_out(csp, c):
+    '''Record that constraint c caused a domain wipe out (or, for plain
+       backtracking, was violated)'''
+    c.weight += 1
+    csp.last_conflict = c
+
+def wipe_out_unit(csp, unit):
+    '''Record that a unit (see CSP.add_unit) caused a wipe out. A unit
+       that is not one of the CSP's constraints has a weight ord_dom_wdeg
+       never reads, so the weights of the constraints it implies are
+       bumped instead'''
+    if unit in csp.vars_to_cons.get(unit.scope[0], ()):
+        wipe_out(csp, unit)
+        return
+    for c in csp.unit_cons.get(unit, ()):
+        c.weight += 1
+    csp.last_conflict = unit
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no 
     propagation at all. Just check fully instantiated constraints'''    
@@ -71,6 +131,7 @@ def prop_BT(csp, newVar=None):
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                wipe_out(csp, c)
                 return False, []
     return True, []
 
@@ -85,7 +146,7 @@ def prop_FC(csp, newVar=None):
             for c in csp.get_cons_with_var(v):
                 if c.get_n_unasgn() == 1:
                     unSigned = c.get_unasgn_vars()[0]
-                    for d in unSigned.cur_domain():
+                    for d in unSigned.iter_cur_domain():
                         unSigned.assign(d)
                         vals = []
                         vars = c.get_scope()
@@ -93,16 +154,16 @@ def prop_FC(csp, newVar=None):
                             vals.append(var.get_assigned_value())
                         unSigned.unassign()
                         if not c.check(vals):
-                            unSigned.prune_value(d)
-                            bookKeeping.append((unSigned, d))
+                            prune(csp, unSigned, d, bookKeeping, c)
                     #DWO
                     if unSigned.cur_domain_size() == 0:
+                        wipe_out(csp, c)
                         return False, bookKeeping
     else:    
         for c in csp.get_cons_with_var(newVar):
             if c.get_n_unasgn() == 1:
                 unSigned = c.get_unasgn_vars()[0]
-                for d in unSigned.cur_domain():
+                for d in unSigned.iter_cur_domain():
                     unSigned.assign(d)
                     vals = []
                     vars = c.get_scope()
@@ -110,10 +171,10 @@ def prop_FC(csp, newVar=None):
                         vals.append(var.get_assigned_value())
                     unSigned.unassign()
                     if not c.check(vals):
-                        unSigned.prune_value(d)
-                        bookKeeping.append((unSigned, d))
+                        prune(csp, unSigned, d, bookKeeping, c)
                 #DWO
                 if unSigned.cur_domain_size() == 0:
+                    wipe_out(csp, c)
                     return False, bookKeeping
     return True, bookKeeping
                 
@@ -134,36 +195,303 @@ def prop_GAC(csp, newVar=None):
     else:
         GACqueue = csp.get_cons_with_var(newVar)
     
-    found = False    
     while(len(GACqueue) > 0):
         c = GACqueue.pop()
-        cScope = c.get_scope()
-        for var in cScope:
-            if not var.is_assigned():
-                for d in var.cur_domain():
-                    found = c.has_support(var, d)
-                    if not found:
-                        var.prune_value(d)
-                        bookKeeping.append((var, d))
-                        #DWO
-                        if var.cur_domain_size() == 0:
-                            GACqueue.clear()
-                            return False, bookKeeping
-                        else:
-                            #add to the queue
-                            temp = csp.get_cons_with_var(var)
-                            GACqueue = GACqueue + temp
+        #each constraint finds its own unsupported values (table 
+        #constraints search for supports, all-different uses matching)
+        for var, d in c.unsupported_values():
+            prune(csp, var, d, bookKeeping, c)
+            #DWO
+            if var.cur_domain_size() == 0:
+                wipe_out(csp, c)
+                GACqueue.clear()
+                return False, bookKeeping
+            else:
+                #add to the queue
+                temp = csp.get_cons_with_var(var)
+                GACqueue = GACqueue + temp
     return True, bookKeeping
             
+def prop_SAC(csp, newVar=None, propagator=prop_GAC, time_budget=None):
+    '''Do singleton arc consistency: after propagator (GAC by default),
+       probe each value of each unassigned variable by assigning it and
+       running propagator, and prune the values whose probe fails.
+
+       A pruning can make other probes fail, so the variables sharing a
+       constraint with a variable that lost values are probed again;
+       once no variable is left to probe, a last full pass is made if
+       anything was pruned since the previous one, so the result is SAC.
+       If time_budget (CPU seconds) runs out first, probing stops early:
+       the prunings made are still sound, just not complete.
+
+       To run it before search set BT.preprocess, e.g.,
+           solver.preprocess = prop_SAC
+       or, with a budget,
+           solver.preprocess = lambda csp: prop_SAC(csp, time_budget=1.0)'''
+    stime = time.process_time()
+    bookKeeping = []
+    status, pruned = propagator(csp, newVar)
+    bookKeeping.extend(pruned)
+    if not status:
+        return False, bookKeeping
+
+    queue = deque(csp.get_all_unasgn_vars())
+    queued = set(queue)
+    changed = False     #values pruned since the last full pass
+    while queue:
+        if time_budget != None and time.process_time() - stime > time_budget:
+            break
+        var = queue.popleft()
+        queued.discard(var)
+        for val in var.cur_domain():
+            if not var.in_cur_domain(val) or probe(csp, var, val, propagator):
+                continue
+            mark = csp.trail.mark() if csp.trail is not None else len(bookKeeping)
+            prune(csp, var, val, bookKeeping)
+            if var.cur_domain_size() == 0:
+                return False, bookKeeping
+            status, pruned = propagator(csp, var)
+            bookKeeping.extend(pruned)
+            if not status:
+                return False, bookKeeping
+            changed = True
+            if csp.trail is not None:
+                reduced = csp.trail.prunings_since(mark)
+            else:
+                reduced = bookKeeping[mark:]
+            for v, d in reduced:
+                for c in csp.get_cons_with_var(v):
+                    for u in c.get_scope():
+                        if not u in queued and not u.is_assigned():
+                            queue.append(u)
+                            queued.add(u)
+        if not queue and changed:
+            changed = False
+            queue.extend(csp.get_all_unasgn_vars())
+            queued.update(queue)
+    return True, bookKeeping
+
+def probe(csp, var, val, propagator):
+    '''Return the status of propagator after assigning val to var,
+       restoring the variable and every value the propagator pruned'''
+    if csp.trail is not None:
+        mark = csp.trail.mark()
+        var.assign(val)
+        status, pruned = propagator(csp, var)
+        csp.trail.undo(mark)
+    else:
+        var.assign(val)
+        status, pruned = propagator(csp, var)
+        for v, d in pruned:
+            v.unprune_value(d)
+    var.unassign()
+    return status
+
+def prop_UNITS(csp, newVar=None):
+    '''Do unit inference on the units of the CSP (see CSP.add_unit) and
+       GAC on the other constraints. In each unit:
+         naked singles: a value fixed in one variable is pruned from the
+           others;
+         hidden singles: a value that fits only one variable is given to
+           it (its other values are pruned);
+         naked pairs/triples: if k variables (k = 2, 3) can only take k
+           values between them, those values are pruned from the others;
+         hidden pairs/triples: if k values fit only k variables, the
+           other values of those variables are pruned.
+       The constraints implied by the units are not propagated. When
+       they are binary NOT-EQUALs (model_1) the rules prune at least as
+       much, at a fraction of the cost. When the implied constraint is an
+       AllDiffConstraint over the whole unit (model_2) the rules are
+       weaker than its GAC (matching-based, see AllDiffConstraint), as
+       they only find subsets of up to 3 variables, so some values GAC
+       would prune are left for search. On a CSP without units this is
+       GAC.'''
+    bookKeeping = []
+    implied = csp.unit_implied
+    if not newVar:
+        units = list(csp.units)
+        cons = [c for c in csp.get_all_cons() if not c in implied]
+    else:
+        units = csp.get_units_with_var(newVar)
+        cons = [c for c in csp.get_cons_with_var(newVar) if not c in implied]
+    unit_queue = deque(units)
+    queued = set(units)
+    cons_queued = set(cons)
+
+    def reduced(var, current=None):
+        #queue the units and constraints of a variable that lost values
+        for u in csp.get_units_with_var(var):
+            if u is not current and not u in queued:
+                unit_queue.append(u)
+                queued.add(u)
+        for c in csp.get_cons_with_var(var):
+            if not c in implied and not c in cons_queued:
+                cons.append(c)
+                cons_queued.add(c)
+
+    while cons or unit_queue:
+        if cons:
+            c = cons.pop()
+            cons_queued.discard(c)
+            for var, d in c.unsupported_values():
+                prune(csp, var, d, bookKeeping, c)
+                #DWO
+                if var.cur_domain_size() == 0:
+                    wipe_out(csp, c)
+                    return False, bookKeeping
+                reduced(var)
+        else:
+            unit = unit_queue.popleft()
+            queued.discard(unit)
+            changed = []
+            if not unit_inference(csp, unit, bookKeeping, changed):
+                return False, bookKeeping
+            for var in changed:
+                reduced(var, unit)
+    return True, bookKeeping
+
+def unit_inference(csp, unit, bookKeeping, changed):
+    '''Internal routine of prop_UNITS. Apply the inference rules to the
+       unit until none applies, adding the variables that lost values to
+       changed. Return False if the unit cannot be satisfied'''
+    scope = unit.scope
+    n = len(scope)
+    while True:
+        masks = [v.value_mask() for v in scope]
+        union = 0
+        for m in masks:
+            union |= m
+        if union.bit_count() < n:
+            #fewer values left than variables
+            wipe_out_unit(csp, unit)
+            return False
+
+        progress = False
+        #naked singles
+        for i in range(n):
+            m = masks[i]
+            if m & (m - 1) == 0:
+                for j in range(n):
+                    if j != i and masks[j] & m:
+                        if masks[j] == m:
+                            wipe_out_unit(csp, unit)
+                            return False
+                        if not prune_mask(csp, scope[j], m, bookKeeping, unit, changed):
+                            return False
+                        masks[j] &= ~m
+                        progress = True
+        if progress:
+            continue
+
+        #hidden singles
+        where = dict()   #value bit -> bitmask of the positions it fits
+        for i in range(n):
+            m = masks[i]
+            while m:
+                low = m & -m
+                where[low] = where.get(low, 0) | (1 << i)
+                m ^= low
+        for b, pos in where.items():
+            if pos & (pos - 1) == 0:
+                i = pos.bit_length() - 1
+                if masks[i] != b:
+                    if not prune_mask(csp, scope[i], masks[i] & ~b, bookKeeping, unit, changed):
+                        return False
+                    masks[i] = b
+                    progress = True
+        if progress:
+            continue
+
+        #naked and hidden subsets, on the variables and values not fixed yet
+        open_vars = [i for i in range(n) if masks[i] & (masks[i] - 1)]
+        open_vals = [b for b, pos in where.items() if pos & (pos - 1)]
+        for k in (2, 3):
+            if len(open_vars) <= k:
+                break
+            for combo in itertools.combinations(open_vars, k):
+                vals = 0
+                for i in combo:
+                    vals |= masks[i]
+                if vals.bit_count() < k:
+                    wipe_out_unit(csp, unit)
+                    return False
+                if vals.bit_count() == k:
+                    for j in open_vars:
+                        if not j in combo and masks[j] & vals:
+                            if not prune_mask(csp, scope[j], masks[j] & vals, bookKeeping, unit, changed):
+                                return False
+                            progress = True
+                    if progress:
+                        break
+            if progress:
+                break
+            for combo in itertools.combinations(open_vals, k):
+                pos, vals = 0, 0
+                for b in combo:
+                    pos |= where[b]
+                    vals |= b
+                if pos.bit_count() < k:
+                    wipe_out_unit(csp, unit)
+                    return False
+                if pos.bit_count() == k:
+                    for i in range(n):
+                        if pos >> i & 1 and masks[i] & ~vals:
+                            if not prune_mask(csp, scope[i], masks[i] & ~vals, bookKeeping, unit, changed):
+                                return False
+                            progress = True
+                    if progress:
+                        break
+            if progress:
+                break
+        if not progress:
+            return True
+
+def prune_mask(csp, var, mask, bookKeeping, unit, changed):
+    '''Internal routine of prop_UNITS. Prune the values in mask (a value
+       bitmask, see Variable.value_mask) from var. Return False on a
+       domain wipe out'''
+    while mask:
+        low = mask & -mask
+        prune(csp, var, low.bit_length() - 1, bookKeeping, unit)
+        mask ^= low
+    changed.append(var)
+    if var.cur_domain_size() == 0:
+        wipe_out_unit(csp, unit)
+        return False
+    return True
+
 def ord_mrv(csp):
-    ''' return variable according to the Minimum Remaining Values heuristic '''
-    #IMPLEMENT
-    mrv, heur = None, 100000
-    
+    ''' return variable according to the Minimum Remaining Values heuristic:
+        an unassigned variable with the smallest current domain, ties
+        broken by the number of constraints the variable is in. The
+        variables are kept in an incrementally maintained DomainSizeIndex
+        (see cspbase) so no scan of the CSP is needed. Remaining ties
+        are broken at random if csp.rng is set.'''
+    if csp.size_index is None:
+        csp.attach_size_index()
+    return csp.size_index.select(csp.rng)
+
+def ord_dom_wdeg(csp):
+    ''' return variable according to the dom/wdeg heuristic: the unassigned
+        variable minimizing current domain size divided by weighted degree,
+        the sum of the weights of its constraints that have at least one
+        other unassigned variable. Constraint weights are bumped by the
+        propagators each time a constraint causes a wipe out (see wipe_out).
+        Ties are broken at random if csp.rng is set.'''
+    best, heur = [], None
     for v in csp.get_all_unasgn_vars():
-        l = len(csp.get_cons_with_var(v))
-        if l < heur:
-            mrv = v
+        wdeg = 0
+        for c in csp.vars_to_cons[v]:
+            if c.get_n_unasgn() > 1:
+                wdeg = wdeg + c.weight
+        l = v.cur_domain_size() / max(wdeg, 1)
+        if heur == None or l < heur:
+            best = [v]
             heur = l
-	
-    return mrv
\ No newline at end of file
+        elif l == heur:
+            best.append(v)
+    if not best:
+        return None
+    if csp.rng is not None:
+        return csp.rng.choice(best)
+    return best[0]